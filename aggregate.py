@@ -0,0 +1,98 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Memoized aggregations of DataFrames shared by plotting functions.
+"""
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from lru import LRUCache
+
+
+def frame_bytes(df):
+    """ Returns size of DataFrame in bytes, used as size of cached aggregation. """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def column_hash(column):
+    """ Returns hash of values of Series, numeric columns and codes of categorical columns are hashed as raw bytes.
+
+    :param column: pandas Series
+    :return: hashlib object
+    """
+    sha = hashlib.sha1(f'{column.name}:{column.dtype}'.encode())
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        sha.update(pd.util.hash_pandas_object(column.cat.categories, index=False).to_numpy().tobytes())
+        values = column.cat.codes.to_numpy()
+    elif isinstance(column.array, pd.arrays.IntegerArray):
+        sha.update(column.isna().to_numpy().tobytes())
+        values = column.array.to_numpy(column.dtype.numpy_dtype, na_value=0)
+    elif column.dtype.kind in 'biufcmM':
+        values = column.to_numpy()
+    else:  # strings and other objects
+        values = pd.util.hash_pandas_object(column, index=False).to_numpy()
+    sha.update(np.ascontiguousarray(values).data)
+    return sha
+
+
+def fingerprint(df, columns):
+    """ Computes fingerprint of given columns of DataFrame from hashes of their values (see column_hash).
+
+    Values are hashed on every call, so DataFrame modified in place gets new fingerprint.
+    :param df: pandas DataFrame
+    :param columns: list of columns
+    :return: hex digest
+    """
+    return hashlib.sha1(b''.join(column_hash(df[name]).digest() for name in columns)).hexdigest()
+
+
+class Aggregator:
+    """ Computes all measures of aggregation in one grouped pass and memoizes results.
+
+    Results are keyed by fingerprint of used columns, group keys and measures, so the same aggregation of the same data
+    is computed only once, even for different DataFrame objects. Only used columns are hashed, numeric ones as raw
+    bytes, so lookup is much cheaper than grouping. Cache is LRU limited by size of results.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.cache = LRUCache(max_bytes, sizeof=frame_bytes)  # (fingerprint, keys, measures) -> aggregated DataFrame
+
+    @instrument.traced()
+    def aggregate(self, df, by, **measures):
+        """ Groups DataFrame by keys and computes named measures (as in DataFrame.groupby(...).agg).
+
+        :param df: pandas DataFrame
+        :param by: list of group keys (columns)
+        :param measures: name of measure -> tuple of column and aggregation function name (e.g. 'sum', 'count'), column
+                         of 'size' (number of rows in group) is None
+        :return: new pandas DataFrame with group keys and measures as columns, caller can modify it
+        """
+        by = list(by)
+        columns = list(dict.fromkeys(by + [column for column, _ in measures.values() if column is not None]))
+        key = (fingerprint(df, columns), tuple(by), tuple(sorted(measures.items(), key=str)))
+
+        result = self.cache.get(key)
+        if result is None:
+            with instrument.span('groupby', by=by, rows=len(df)):
+                grouped = df[columns].groupby(by)
+                named = {name: measure for name, measure in measures.items() if measure[0] is not None}
+                result = grouped.agg(**named) if named else grouped.size().to_frame('size')
+                for name, (column, _) in measures.items():
+                    if column is None:
+                        result[name] = grouped.size()
+                result = result[list(measures)].reset_index()
+            self.cache.put(key, result)
+        return result.copy()
+
+
+aggregator = Aggregator()  # shared by all plotting functions
+
+
+def aggregate(df, by, **measures):
+    """ Aggregates DataFrame with shared memoizing aggregator, see Aggregator.aggregate. """
+    return aggregator.aggregate(df, by, **measures)
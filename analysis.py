@@ -12,8 +12,13 @@ from textwrap import wrap
 from matplotlib import pyplot as plt
 import pandas as pd
 import seaborn as sns
-import numpy as np
 import os
+
+from aggregate import aggregate
+from download import COUNT, DataDownloader
+from frame import time_keys
+import instrument
+from snapshot import load_snapshot, save_snapshot
 # muzete pridat libovolnou zakladni knihovnu ci knihovnu predstavenou na prednaskach
 # dalsi knihovny pak na dotaz
 
@@ -25,48 +30,83 @@ to_int8 = ['p5a', 'p6', 'p7', 'p8', 'p9', 'p10', 'p11', 'p15', 'p16', 'p18', 'p1
            'p27', 'p28', 'p49', 'p50a', 'p50b', 'p51', 'p55a', 'p57', 'p58']
 
 # Ukol 1: nacteni dat
-def get_dataframe(filename: str, verbose: bool = False) -> pd.DataFrame:
+@instrument.traced(rows=len)
+def get_dataframe(filename: str = None, verbose: bool = False, columns: list = None) -> pd.DataFrame:
     """ Loads zipped dataframe and lower its size by changing to better data types.
 
-        :param filename: path to stored dataframe
+        If filename is not given, dataframe is created by DataDownloader with final data types, so no conversion is
+        needed. Converted dataframe is stored as snapshot next to the file and later calls load it memory-mapped, until
+        the file changes (see snapshot.load_snapshot).
+        :param filename: path to stored dataframe, dataframe is created by DataDownloader if None
         :param verbose: if true print size of dataframe
+        :param columns: list of columns to load, all columns if not set
         :return: pandas DataFrame with changed types of columns
         """
-    data = pd.read_pickle(filename, compression="gzip")
+    if filename is None:
+        names = None if columns is None else [col for col in columns if col != 'date'] + ['p2a']
+        data = DataDownloader().get_dataframe(columns=None if names is None else list(dict.fromkeys(names)))
+        data.insert(0, column='date', value=data['p2a'])
+        data = data if columns is None else data[columns]
+        if verbose:
+            print(f'new_size={round(data.memory_usage(index=False, deep=True).sum() / B_to_MB, 2)} MB')
+        return data
+
+    # already converted dataframe
+    data = load_snapshot(filename, columns)
+    if data is not None:
+        if verbose:
+            print(f'new_size={round(data.memory_usage(index=False, deep=True).sum() / B_to_MB, 2)} MB')
+        return data
+
+    with instrument.span('read_pickle'):
+        data = pd.read_pickle(filename, compression="gzip")
 
     if verbose:
         print(f'orig_size={round(data.memory_usage(index=False, deep=True).sum() / B_to_MB, 2)} MB')
 
-    # change types for specific columns
-    for col in to_category:
-        data[col] = data[col].astype('category')
-    for col in to_float:
-        data[col] = data[col].astype('float64')
-    for col in to_int8:
-        data[col] = data[col].astype('int8')
-
-    # create datetime column from string
-    data.insert(0, column='date', value=data['p2a'].astype('datetime64'))
+    with instrument.span('convert', rows=len(data)):
+        # change types for specific columns
+        for col in to_category:
+            data[col] = data[col].astype('category')
+        for col in to_float:
+            data[col] = data[col].astype('float64')
+        for col in to_int8:
+            data[col] = data[col].astype('int8')
+
+        # create datetime column from string
+        data.insert(0, column='date', value=pd.to_datetime(data['p2a']))
+        # integer time keys, so plots group months or weeks as integers
+        keys = time_keys(data['date'], pd.to_numeric(data['p2b'], errors='coerce').fillna(-100) // 100)
+        for name, values in keys.items():
+            data[name] = values
 
     if verbose:
         print(f'new_size={round(data.memory_usage(index=False, deep=True).sum() / B_to_MB, 2)} MB')
 
-    return data
+    save_snapshot(filename, data)
+    return data if columns is None else data[columns]
 
 # Ukol 2: následky nehod v jednotlivých regionech
+@instrument.traced()
 def plot_conseq(df: pd.DataFrame, fig_location: str = None,
                 show_figure: bool = False):
     """ Plots crash consequences for every region based on theirseverity.
 
-        :param df: pandas DataFrame
+        :param df: pandas DataFrame of crashes or of groups of crashes with COUNT column (see
+                   DataDownloader.cube_dataframe)
         :param fig_location: location where the figure will be saved, if None figure is not saved
         :param show_figure: if true show figure
         """
+    # sums of consequences and number of crashes for every region in one grouped pass, groups of cube count crashes
+    crashes = (COUNT, 'sum') if COUNT in df else (None, 'size')
+    conseq = aggregate(df, ['region'], p13a=('p13a', 'sum'), p13b=('p13b', 'sum'), p13c=('p13c', 'sum'),
+                       crashes=crashes)
+
     # create data frames for each subplot
-    p13a = df[['region', 'p13a']].groupby('region').agg(np.sum).reset_index()
-    p13b = df[['region', 'p13b']].groupby('region').agg(np.sum).reset_index()
-    p13c = df[['region', 'p13c']].groupby('region').agg(np.sum).reset_index()
-    crashes = df['region'].value_counts().sort_values(ascending=False)
+    p13a = conseq[['region', 'p13a']]
+    p13b = conseq[['region', 'p13b']]
+    p13c = conseq[['region', 'p13c']]
+    crashes = conseq.set_index('region')['crashes'].sort_values(ascending=False)
 
     titles = list(['Usmrtených osôb', 'Ťažko zranených osôb', 'Ľahko zranených osôb', 'Celkový  počet nehôd'])
     # main figure settings
@@ -97,12 +137,14 @@ def plot_conseq(df: pd.DataFrame, fig_location: str = None,
     fig.tight_layout(pad=2.0)
 
     if fig_location is not None:
-        plt.savefig(f'{fig_location}', bbox_inches="tight")
+        with instrument.span('savefig'):
+            plt.savefig(f'{fig_location}', bbox_inches="tight")
 
     if show_figure:
         plt.show()
 
 # Ukol3: příčina nehody a škoda
+@instrument.traced()
 def plot_damage(df: pd.DataFrame, fig_location: str = None,
                 show_figure: bool = False):
     """ Plots damage cost of accidents in 4 regions w.r.t. cause of accident.
@@ -137,7 +179,7 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None,
     sns.set_style("darkgrid")
 
     # count number of  accidents w.r.t. region, damage costs, cause of accident and add it as column "count"
-    data = data.groupby(['region', 'dmg_cost', 'p12'])['p53'].count().reset_index(name='count')
+    data = aggregate(data, ['region', 'dmg_cost', 'p12'], count=('p53', 'count'))
     fig, axs = plt.subplots(2, 2)
 
     fig.set_figwidth(10)
@@ -170,17 +212,20 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None,
                fancybox=False, shadow=False, borderpad=None, frameon=False)
 
     if fig_location is not None:
-        plt.savefig(f'{fig_location}', bbox_inches="tight")
+        with instrument.span('savefig'):
+            plt.savefig(f'{fig_location}', bbox_inches="tight")
 
     if show_figure:
         plt.show()
 
 # Ukol 4: povrch vozovky
+@instrument.traced()
 def plot_surface(df: pd.DataFrame, fig_location: str = None,
                  show_figure: bool = False):
     """  Visualize number of accidents w.r.t. road surface in 4 regions for every month in years.
 
-        :param df: pandas DataFrame
+        :param df: pandas DataFrame of crashes or of groups of crashes with COUNT column (see
+                   DataDownloader.cube_dataframe)
         :param fig_location: location where the figure will be saved, if None figure is not saved
         :param show_figure: if true show figure
         """
@@ -193,14 +238,17 @@ def plot_surface(df: pd.DataFrame, fig_location: str = None,
                      7: 'rozliaty olej, nafta apod.', 8: 'súvislý sneh',
                      9: 'náhla zmena stavu', 0: 'iný stav'}
 
-    data = df[['region', 'date', 'p16']]  # get needed columns
-
-    # copy the data frame, otherwise loc causes a warning
-    data_copy = data.copy()
-    data_copy.loc[:, 'date'] = pd.to_datetime(data["date"].dt.strftime('%Y-%m'))  # remove days
+    # months as integer YYYYMM keys, computed only for older dataframes without them
+    weighted = COUNT in df  # groups of cube count crashes
+    data = df[['region', 'p16'] + ([COUNT] if weighted else [])]
+    data = data.assign(yyyymm=df['yyyymm'] if 'yyyymm' in df else time_keys(df['date'])['yyyymm'])
 
     # crosstab indexes are region and date,  columns are road surface
-    ctab_data = pd.crosstab([data_copy.region, data_copy.date], data_copy.p16).rename(columns=p16_to_string)
+    counts = aggregate(data, ['region', 'yyyymm', 'p16'], count=(COUNT, 'sum') if weighted else (None, 'size'))
+    counts = counts[counts['yyyymm'] >= 0]  # missing dates
+    counts.insert(1, column='date', value=pd.to_datetime(counts.pop('yyyymm').astype(str), format='%Y%m'))
+    ctab_data = counts.set_index(['region', 'date', 'p16'])['count'].unstack('p16', fill_value=0)
+    ctab_data = ctab_data.rename(columns=p16_to_string)
 
     # stack data w.r.t. road surface(p16) -> values are in column "count"
     stacked = ctab_data.stack()
@@ -235,7 +283,8 @@ def plot_surface(df: pd.DataFrame, fig_location: str = None,
                fancybox=False, shadow=False, borderpad=None, frameon=False)
 
     if fig_location is not None:
-        plt.savefig(f'{fig_location}')
+        with instrument.span('savefig'):
+            plt.savefig(f'{fig_location}')
 
     if show_figure:
         plt.show()
@@ -246,7 +295,7 @@ if __name__ == "__main__":
     # zde je ukazka pouziti, tuto cast muzete modifikovat podle libosti
     # skript nebude pri testovani pousten primo, ale budou volany konkreni ¨
     # funkce.
-    df = get_dataframe("accidents.pkl.gz")
+    df = get_dataframe()
     plot_conseq(df, fig_location="01_nasledky.png", show_figure=True)
     plot_damage(df, "02_priciny.png", True)
     plot_surface(df, "03_stav.png", True)
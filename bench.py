@@ -0,0 +1,392 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Benchmarks of data pipeline on synthetic zips, every case is measured in its own process.
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')  # headless backend, figures are only rendered
+import matplotlib.pyplot as plt
+import pandas as pd
+
+import aggregate
+import store
+import synth
+from columns import count_matrix
+from download import DataDownloader, frame_rows
+from instrument import peak_rss, reset_peak_rss, rss
+
+PARAMS = 'synth.json'  # parameters of synthetic zips, stored in folder with zips
+PICKLE = 'accidents.pkl.gz'  # DataFrame in format of accidents.pkl.gz created from synthetic zips
+B_to_MB = 1 << 20
+GEO_PIXELS = (1400, 1000)  # rows and columns of pixels of one axes of plot_geo (figsize 20x15 at 100 dpi)
+
+
+def downloader(folder):
+    """ Returns DataDownloader which uses only zips in folder. """
+    return DataDownloader(folder=folder, offline=True)
+
+
+def load_frame(folder):
+    """ Returns DataFrame of all regions with 'date' column, as it is used by plotting functions. """
+    df = downloader(folder).get_dataframe()
+    df.insert(0, column='date', value=df['p2a'])
+    return df
+
+
+def prepare_data(folder, rows, seed=0):
+    """ Writes synthetic zips into folder, if they were not created with the same parameters yet.
+
+    Disk caches and pickle created from previous zips are removed.
+    :param folder: directory of zips
+    :param rows: number of crashes in all zips
+    :param seed: seed of random generator
+    """
+    params = {'rows': rows, 'seed': seed}
+    try:
+        with open(os.path.join(folder, PARAMS), 'r') as f:
+            if json.load(f) == params and glob.glob(os.path.join(folder, '*.zip')):
+                return
+    except (OSError, ValueError):
+        pass
+
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    synth.write_archive(folder, rows, seed=seed)
+    store.write_json(os.path.join(folder, PARAMS), params)
+
+
+def clear_cache(folder):
+    """ Removes disk caches of all regions. """
+    for path in glob.glob(os.path.join(folder, downloader(folder).cache_file.format('*'))):
+        shutil.rmtree(path)
+
+
+def build_cache(folder):
+    """ Builds disk caches of all regions, if they are not built yet. """
+    with contextlib.redirect_stdout(sys.stderr):
+        downloader(folder).get_list(columns=['region'])
+
+
+def write_pickle(folder):
+    """ Writes DataFrame of synthetic zips in format of accidents.pkl.gz (date as string, no converted types).
+
+    Missing values of integer columns (malformed cells) are written as -1, so integer columns stay integers as in
+    accidents.pkl.gz and analysis.get_dataframe can convert them.
+    """
+    path = os.path.join(folder, PICKLE)
+    if os.path.exists(path):
+        return
+    from frame import TIME_KEYS
+
+    with contextlib.redirect_stdout(sys.stderr):
+        df = downloader(folder).get_dataframe().drop(columns=TIME_KEYS)
+    for name in df.columns:
+        column = df[name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            dtype = column.cat.categories.dtype
+            if dtype.kind in 'iu' and column.isna().any():
+                column = column.cat.add_categories(-1).fillna(-1)
+            df[name] = column.astype(dtype)
+        elif isinstance(column.array, pd.arrays.IntegerArray):
+            df[name] = column.fillna(-1).astype(column.dtype.numpy_dtype)
+    df['p2a'] = df['p2a'].dt.strftime('%Y-%m-%d')
+    df.to_pickle(path, compression='gzip')
+
+
+def remove_snapshot(folder):
+    """ Removes snapshot of pickle, so it is converted again. """
+    from snapshot import snapshot_path
+
+    shutil.rmtree(snapshot_path(os.path.join(folder, PICKLE)), ignore_errors=True)
+
+
+def write_snapshot(folder):
+    """ Creates snapshot of pickle, if it does not exist. """
+    import analysis
+
+    with contextlib.redirect_stdout(sys.stderr):
+        analysis.get_dataframe(os.path.join(folder, PICKLE))
+
+
+def parse_region_data_case(folder):
+    """ Measures parsing of the largest region straight from zips. """
+    d = downloader(folder)
+    return lambda: frame_rows(d.parse_region_data('PHA')[1])
+
+
+def get_list_case(folder):
+    """ Measures get_list of all regions, cold or warm depends on setup. """
+    d = downloader(folder)
+    return lambda: frame_rows(d.get_list()[1])
+
+
+def get_dataframe_case(folder):
+    """ Measures analysis.get_dataframe of pickle, cold or warm depends on setup. """
+    import analysis
+
+    return lambda: analysis.get_dataframe(os.path.join(folder, PICKLE)).shape[0]
+
+
+def plot_stat_case(folder):
+    """ Measures aggregation of plot_stat, rendering is not measured. """
+    header, data = downloader(folder).get_list(columns=['region', 'rok'])
+    return lambda: int(count_matrix(data[0], data[1])[2].sum())
+
+
+def make_geo_case(folder):
+    """ Measures conversion of DataFrame to GeoDataFrame. """
+    import geo
+
+    df = load_frame(folder)
+    return lambda: geo.make_geo(df).shape[0]
+
+
+def plot_geo_case(folder):
+    """ Measures aggregation of plot_geo with raster, accidents in and outside city are counted into pixels. """
+    import geo
+
+    gdf = geo.make_geo(load_frame(folder))
+    minx, miny, maxx, maxy = gdf.total_bounds
+
+    def run():
+        counts = 0
+        for location in [1, 2]:
+            points = gdf[gdf['p5a'] == location]
+            counts += int(geo.rasterize(points.geometry.x.to_numpy(), points.geometry.y.to_numpy(),
+                                        (minx, maxx, miny, maxy), GEO_PIXELS).sum())
+        return counts
+    return run
+
+
+def plot_cluster_case(folder):
+    """ Measures aggregation of plot_cluster (projection, KMeans clustering and counts of clusters). """
+    import geo
+
+    gdf = geo.make_geo(load_frame(folder))
+    return lambda: int(geo.cluster_crashes(gdf)[1]['cnt'].sum())
+
+
+def grid_case(folder):
+    """ Measures viewport query of grid pyramid over bounding box of all synthetic crashes. """
+    d = downloader(folder)
+    bounds = (synth.X_RANGE[0], synth.Y_RANGE[0], synth.X_RANGE[1], synth.Y_RANGE[1])
+    return lambda: int(d.grid(bounds)[2][2].sum())
+
+
+class RecordingAggregator(aggregate.Aggregator):
+    """ Aggregator which records all aggregations done by plotting function, so they can be measured alone. """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def aggregate(self, df, by, **measures):
+        self.calls.append((df, by, measures))
+        return super().aggregate(df, by, **measures)
+
+
+def aggregation_case(module, function, cube=False):
+    """ Returns case which measures aggregation phase of plotting function.
+
+    Plotting function is called once (not measured) with recording aggregator, then recorded aggregations are repeated
+    by new aggregator, so neither rendering nor memoized results are measured. Case fails if plotting function fails.
+    :param module: name of module with plotting function
+    :param function: name of plotting function
+    :param cube: plot groups of cube (as report does) instead of rows, query of cube is measured too
+    :return: function preparing case in folder
+    """
+    def case(folder):
+        import importlib
+        from report import CUBE_BY
+
+        plots = importlib.import_module(module)
+        df = downloader(folder).cube_dataframe(CUBE_BY) if cube else load_frame(folder)
+        if module == 'doc':
+            df = plots.clean_data(df)
+        recorder = aggregate.aggregator = RecordingAggregator()
+        try:
+            if function == 'severity_wrt_cause':
+                plots.severity_wrt_cause(df, plots.accidents_cause(df, region='JHM'), region='JHM')
+            elif module == 'doc':
+                plots.accidents_cause(df, region='JHM')
+            else:
+                getattr(plots, function)(df)
+        finally:
+            plt.close('all')
+
+        def run():
+            if cube:
+                downloader(folder).cube_dataframe(CUBE_BY)  # query of cube replaces loading of rows
+            measured = aggregate.Aggregator()
+            for df_, by, measures in recorder.calls:
+                measured.aggregate(df_, by, **measures)
+            return sum(df_.shape[0] for df_, _, _ in recorder.calls)
+        return run
+    return case
+
+
+# benchmark cases, name -> (setup in parent process, function preparing case in child process which returns measured
+# function, measured function returns number of processed rows)
+CASES = {
+    'parse_region_data': (None, parse_region_data_case),
+    'get_list_cold': (clear_cache, get_list_case),
+    'get_list_warm': (build_cache, get_list_case),
+    'get_dataframe_cold': (lambda folder: (write_pickle(folder), remove_snapshot(folder)), get_dataframe_case),
+    'get_dataframe_warm': (lambda folder: (write_pickle(folder), write_snapshot(folder)), get_dataframe_case),
+    'plot_stat': (build_cache, plot_stat_case),
+    'plot_conseq': (build_cache, aggregation_case('analysis', 'plot_conseq')),
+    'plot_damage': (build_cache, aggregation_case('analysis', 'plot_damage')),
+    'plot_surface': (build_cache, aggregation_case('analysis', 'plot_surface')),
+    'plot_conseq_cube': (build_cache, aggregation_case('analysis', 'plot_conseq', cube=True)),
+    'plot_surface_cube': (build_cache, aggregation_case('analysis', 'plot_surface', cube=True)),
+    'accidents_cause': (build_cache, aggregation_case('doc', 'accidents_cause')),
+    'severity_wrt_cause': (build_cache, aggregation_case('doc', 'severity_wrt_cause')),
+    'make_geo': (build_cache, make_geo_case),
+    'plot_geo': (build_cache, plot_geo_case),
+    'plot_cluster': (build_cache, plot_cluster_case),
+    'grid': (build_cache, grid_case),
+}
+
+
+def error_message(exc):
+    """ Returns the first line of exception message with its type, it is reported as error of case. """
+    return f'{type(exc).__name__}: {str(exc).splitlines()[0] if str(exc) else ""}'
+
+
+def measure(name, folder):
+    """ Prepares and measures one case in this process.
+
+    :param name: name of case (key of CASES)
+    :param folder: directory of zips
+    :return: dictionary with number of rows, seconds, peak RSS of process and growth of peak RSS during case in MB
+    """
+    run = CASES[name][1](folder)
+    before = rss()
+    start = time.perf_counter()
+    rows = run()
+    seconds = time.perf_counter() - start
+    peak = peak_rss()
+    return {'rows': rows, 'seconds': round(seconds, 4), 'peak_rss_mb': round(peak / B_to_MB, 1),
+            'rss_growth_mb': round(max(peak - before, 0) / B_to_MB, 1)}
+
+
+def run_case(name, folder, repeat=1):
+    """ Runs case in new processes, so peak RSS belongs only to this case, the best of repeated runs is kept.
+
+    :param name: name of case (key of CASES)
+    :param folder: directory of zips
+    :param repeat: number of runs
+    :return: dictionary with result of case (see measure) or with error message
+    """
+    best = None
+    for _ in range(repeat):
+        setup = CASES[name][0]
+        try:
+            if setup is not None:
+                setup(folder)
+        except Exception as exc:
+            return {'error': f'setup: {error_message(exc)}'}
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', name, '--folder', folder],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        try:
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            lines = process.stderr.strip().splitlines()
+            return {'error': lines[-1] if lines else f'exit code {process.returncode}'}
+        if 'error' in result:
+            return result
+        if best is None:
+            best = result
+        else:
+            best['seconds'] = min(best['seconds'], result['seconds'])
+            best['peak_rss_mb'] = min(best['peak_rss_mb'], result['peak_rss_mb'])
+            best['rss_growth_mb'] = min(best['rss_growth_mb'], result['rss_growth_mb'])
+    return best
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Finds regressions of time and peak RSS against baseline results of the same data.
+
+    :param results: results of benchmarks (see run_benchmarks)
+    :param baseline: older results of benchmarks
+    :param tolerance: allowed relative growth of time and memory
+    :return: list of messages describing regressions
+    """
+    if baseline.get('rows') != results.get('rows'):
+        return []  # different data, results are not comparable
+
+    regressions = []
+    for name, result in results['cases'].items():
+        old = baseline['cases'].get(name, {})
+        for key in ['seconds', 'peak_rss_mb']:
+            if key in result and key in old and result[key] > old[key] * (1 + tolerance):
+                regressions.append(f'{name}: {key} {old[key]} -> {result[key]}')
+    return regressions
+
+
+def run_benchmarks(folder='bench_data', rows=100000, cases=None, repeat=1, seed=0):
+    """ Runs benchmark cases on synthetic zips, zips are created if needed.
+
+    :param folder: directory of synthetic zips (relative to working directory, as folder of DataDownloader)
+    :param rows: number of crashes in all zips
+    :param cases: list of cases (keys of CASES), all cases if not set
+    :param repeat: number of runs of every case, the best run is kept
+    :param seed: seed of random generator of zips
+    :return: dictionary with number of rows and results of cases
+    """
+    cases = list(CASES) if cases is None else list(cases)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        raise ValueError(f'unknown cases: {unknown}')
+
+    prepare_data(folder, rows, seed)
+    return {'rows': rows, 'cases': {name: run_case(name, folder, repeat) for name in cases}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', default='bench_data', help='Set directory of synthetic zips')
+    parser.add_argument('--rows', type=int, default=100000, help='Set number of crashes in synthetic zips')
+    parser.add_argument('--seed', type=int, default=0, help='Set seed of random generator of zips')
+    parser.add_argument('--repeat', type=int, default=1, help='Set number of runs of every case')
+    parser.add_argument('--output', default=None, help='Set JSON file where results are stored')
+    parser.add_argument('--baseline', default=None, help='Set JSON file with results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Set allowed relative regression')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)  # measure one case in this process
+    parser.add_argument('cases', nargs='*', help='Cases to run, all cases if not set')
+    args = parser.parse_args()
+
+    if args.case is not None:
+        reset_peak_rss()  # peak of this process only, not of parent which prepared data
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                report = measure(args.case, args.folder)
+        except Exception as exc:
+            report = {'error': error_message(exc)}
+        print(json.dumps(report))
+        sys.exit(0)
+
+    results = run_benchmarks(args.folder, args.rows, args.cases or None, args.repeat, args.seed)
+    for case, result in results['cases'].items():
+        print(f'{case}: ' + ', '.join(f'{key}={value}' for key, value in result.items()))
+    if args.output:
+        store.write_json(args.output, results)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = compare(results, json.load(f), args.tolerance)
+        for message in found:
+            print(f'regression: {message}')
+        sys.exit(1 if found else 0)
@@ -0,0 +1,200 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Compact column types, dictionary-encoded strings and integers stored in the narrowest data type.
+"""
+
+import numpy as np
+
+INT_TYPES = [np.int8, np.int16, np.int32, np.int64]
+CODE_TYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+
+
+def smallest_type(low, high, types):
+    """ Returns the first type from types which can hold every value between low and high. """
+    for t in types:
+        if np.iinfo(t).min <= low and high <= np.iinfo(t).max:
+            return t
+    return types[-1]
+
+
+class EncodedColumn:
+    """ Dictionary-encoded column of strings.
+
+    Every value is stored as integer code into sorted dictionary of unique values. Column behaves as numpy array of
+    strings where it is needed (np.asarray decodes it), slicing and comparing with string works directly on codes.
+    """
+
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    @classmethod
+    def encode(cls, values):
+        """ Encodes numpy array of strings.
+
+        :param values: numpy array of strings
+        :return: EncodedColumn
+        """
+        dictionary, inverse = np.unique(values, return_inverse=True)
+        dictionary = dictionary.astype(f'<U{max(int(np.char.str_len(dictionary).max(initial=0)), 1)}')
+        codes = inverse.reshape(-1).astype(smallest_type(0, dictionary.shape[0], CODE_TYPES))
+        return cls(codes, dictionary)
+
+    @classmethod
+    def concatenate(cls, columns):
+        """ Concatenates encoded columns, their dictionaries are merged.
+
+        :param columns: list of EncodedColumn
+        :return: EncodedColumn
+        """
+        dictionary = np.unique(np.concatenate([column.dictionary for column in columns]))
+        code_type = smallest_type(0, dictionary.shape[0], CODE_TYPES)
+        codes = np.concatenate([np.searchsorted(dictionary, column.dictionary).astype(code_type)[column.codes]
+                                for column in columns])
+        return cls(codes, dictionary)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return self.dictionary.dtype
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.dictionary.nbytes
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, key):
+        if np.isscalar(key) and not isinstance(key, (bool, np.bool_)):
+            return self.dictionary[self.codes[key]]
+        return EncodedColumn(self.codes[key], self.dictionary)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.decode() if dtype is None else self.decode().astype(dtype)
+
+    def __eq__(self, other):
+        return (self.dictionary == other)[self.codes]
+
+    def __ne__(self, other):
+        return (self.dictionary != other)[self.codes]
+
+    __hash__ = None
+
+    def decode(self):
+        """ Returns column as numpy array of strings. """
+        return self.dictionary[self.codes]
+
+    def __repr__(self):
+        return f'EncodedColumn({self.decode()!r})'
+
+
+def compact(column):
+    """ Converts column into compact type.
+
+    Strings with few unique values are dictionary-encoded, other strings are stored with the length of the longest
+    string. Integers are stored in the narrowest integer type which can hold all values, floats are not changed.
+    :param column: numpy array
+    :return: numpy array or EncodedColumn
+    """
+    if isinstance(column, EncodedColumn):
+        return column
+    if column.dtype.kind == 'U':
+        encoded = EncodedColumn.encode(column)
+        if encoded.dictionary.shape[0] <= column.shape[0] // 2:
+            return encoded
+        return column.astype(encoded.dtype)
+    if column.dtype.kind == 'i' and column.shape[0]:
+        return column.astype(smallest_type(int(column.min()), int(column.max()), INT_TYPES), copy=False)
+    return column
+
+
+def concat_parts(columns):
+    """ Concatenates parts of one column, works for numpy arrays and EncodedColumn.
+
+    :param columns: list of parts of column
+    :return: numpy array or EncodedColumn
+    """
+    if all(isinstance(column, EncodedColumn) for column in columns):
+        return EncodedColumn.concatenate(columns)
+    return np.concatenate([np.asarray(column) for column in columns])
+
+
+def isin(column, values):
+    """ Tests which values of column are in values, encoded column is tested only on its dictionary.
+
+    :param column: numpy array or EncodedColumn
+    :param values: list of tested values
+    :return: numpy array of booleans
+    """
+    if isinstance(column, EncodedColumn):
+        return np.isin(column.dictionary, values)[column.codes]
+    return np.isin(np.asarray(column), values)
+
+
+def factorize(column):
+    """ Factorizes column into sorted unique values and codes of rows, encoded column reuses its codes.
+
+    :param column: numpy array or EncodedColumn
+    :return: tuple of numpy array of unique values and numpy array of codes (index of value of every row)
+    """
+    if isinstance(column, EncodedColumn):
+        # drop values of dictionary which are not in column (e.g. after slicing)
+        present = np.bincount(column.codes, minlength=column.dictionary.shape[0]) > 0
+        remap = np.cumsum(present) - 1
+        return column.dictionary[present], remap[column.codes]
+    values, codes = np.unique(np.asarray(column), return_inverse=True)
+    return values, codes.reshape(-1)
+
+
+def count_matrix(row_keys, column_keys, weights=None):
+    """ Counts rows for every pair of keys, both keys are factorized once and counted in one bincount pass.
+
+    :param row_keys: numpy array or EncodedColumn, its unique values are rows of result
+    :param column_keys: numpy array or EncodedColumn, its unique values are columns of result
+    :param weights: numpy array with weight of every row (e.g. already aggregated counts), every row counts once if
+                    not set
+    :return: tuple of unique row keys, unique column keys and 2D numpy array of counts
+    """
+    row_values, row_codes = factorize(row_keys)
+    column_values, column_codes = factorize(column_keys)
+    shape = (row_values.shape[0], column_values.shape[0])
+    counts = np.bincount(row_codes * shape[1] + column_codes, weights=weights, minlength=shape[0] * shape[1])
+    return row_values, column_values, counts.astype(np.int64).reshape(shape)
+
+
+def group_by(keys, weights=()):
+    """ Groups rows by values of key columns, counts rows and sums weights of every group in bincount passes.
+
+    :param keys: list of key columns (numpy arrays or EncodedColumn), all rows are one group if empty
+    :param weights: list of numpy arrays which are summed in groups
+    :return: tuple of list of key columns of groups (sorted by keys), numpy array of counts and list of numpy arrays
+             of sums
+    """
+    rows = keys[0].shape[0] if keys else (weights[0].shape[0] if weights else 0)
+    factorized = [factorize(key) for key in keys]
+
+    # one code for every combination of keys
+    combined = np.zeros(rows, dtype=np.int64)
+    for values, codes in factorized:
+        combined = combined * values.shape[0] + codes
+    groups, inverse = np.unique(combined, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    counts = np.bincount(inverse, minlength=groups.shape[0])
+    sums = []
+    for weight in weights:
+        total = np.bincount(inverse, weights=weight, minlength=groups.shape[0])
+        sums.append(total.astype(np.int64) if weight.dtype.kind in 'iub' else total)
+
+    # decompose combined codes back into keys
+    group_keys = []
+    for values, _ in reversed(factorized):
+        groups, codes = np.divmod(groups, values.shape[0])
+        group_keys.insert(0, values[codes])
+    return group_keys, counts, sums
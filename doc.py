@@ -14,7 +14,12 @@ import scipy.stats as st
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
+from aggregate import aggregate
+from download import DataDownloader
+import instrument
 
+
+@instrument.traced()
 def clean_data(df):
     """Select only columns with data necessary for this task, drop rows with None value.
     Selected columns are:   p10 - accident caused by
@@ -41,6 +46,7 @@ def print_table(df):
     
 
 # severity by accident cause
+@instrument.traced()
 def severity_wrt_cause(df, accidents, region='CZ', save_fig=None, show_fig=False):
     """Severity of injuries in car accidents w.r.t. accident cause.
     
@@ -61,10 +67,10 @@ def severity_wrt_cause(df, accidents, region='CZ', save_fig=None, show_fig=False
     # melt to get severity into one column
     cause_df = pd.melt(sev_df, id_vars=['cause'], var_name='severity')
 
-    cause_df = cause_df.groupby(['cause', 'severity']).agg(people=('value','sum'), accidents=('value', 'count')).reset_index()
+    cause_df = aggregate(cause_df, ['cause', 'severity'], people=('value', 'sum'), accidents=('value', 'count'))
     
     # total number of injured people for every accident cause
-    total_injured = cause_df.groupby(['cause']).people.agg('sum').reset_index()
+    total_injured = aggregate(cause_df, ['cause'], people=('people', 'sum'))
     total_injured = pd.concat([total_injured]*3, ignore_index=True).sort_values(by='cause').reset_index()
 
     
@@ -121,17 +127,19 @@ def severity_wrt_cause(df, accidents, region='CZ', save_fig=None, show_fig=False
     fig.subplots_adjust(bottom=0.2)
 
     if save_fig is not None:
-        plt.savefig(save_fig)
+        with instrument.span('savefig'):
+            plt.savefig(save_fig)
     if show_fig:
         plt.show()
 
 
+@instrument.traced()
 def accidents_cause(df, region='CZ', save_fig=None, show_fig=False):
     df = select_region(df, region)
 
     # create  needed dataframe with values grouped by cause of accident
     acc_df = pd.DataFrame({'caused_by': df['p10'], 'cause': df['p12'], 'dead': df['p13a'], 'heavily_injured': df['p13b'], 'lightly_injured': df['p13c']})
-    caused_by_df = acc_df.groupby('caused_by').cause.agg('count').to_frame('accidents').reset_index()
+    caused_by_df = aggregate(acc_df, ['caused_by'], accidents=('cause', 'count'))
 
     # change "cause_by" column lables to text description
     caused_by_labels = {'1':'vodičom motor. vozdila', '2': 'vodičom nemotor. vozdila', '3': 'chodcom', '4': 'zverou', '5': 'iným účastníkom provozu', 
@@ -175,14 +183,15 @@ def accidents_cause(df, region='CZ', save_fig=None, show_fig=False):
         plt.minorticks_off()
 
         if save_fig is not None:
-            plt.savefig(save_fig)
+            with instrument.span('savefig'):
+                plt.savefig(save_fig)
         if show_fig:
             plt.show()
     
     return caused_by_df.accidents.sum() # number of
 
 if __name__ == '__main__':
-    df = pd.read_pickle("accidents.pkl.gz")
+    df = DataDownloader().get_dataframe()
     df = clean_data(df)
     accidents = accidents_cause(df, region='JHM')
     severity_wrt_cause(df, accidents, save_fig='fig.png', show_fig=True, region='JHM')
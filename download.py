@@ -5,18 +5,26 @@ Project: IZV
 Description: Script for downloading, parsing and storing car crashes data in czech republic for given years and regions.
 """
 
-import gzip
-import pickle
-from io import TextIOWrapper
 import glob
 import requests
 from zipfile import ZipFile
-import requests
 from bs4 import BeautifulSoup
 import numpy as np
+import pandas as pd
 import os
-import csv
 import re
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from columns import EncodedColumn, compact, concat_parts, group_by, isin
+from fetch import Fetcher
+from frame import NAMES, source_columns, to_dataframe
+import instrument
+from lru import LRUCache
+import store
 
 # header for requests on https://ehw.fit.vutbr.cz/izv/
 HEADER = {
@@ -48,16 +56,529 @@ floats = [52, 51, 50, 49, 48, 47]  # indexes of columns with value type float
 ints = [1, 2, 3, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19,
         20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35,
         36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 55, 59, 62, 63, 64, 65]  # indexes of columns with value type int
+# data types of parsed columns, before they are converted to compact types (see columns.compact)
+types = ['<U32' if i in strings else float if i in floats else int for i in range(C_LEN)]
+
+LAYOUT = 'year'  # disk cache of region is partitioned by years, months are ranges of rows inside year partition
+SOURCE = 'zdroj'  # hidden column of year partition with name of zip every row comes from
+
+# aggregate cube of every year partition, counts and sums of injuries grouped by month and code columns
+CUBE = 'cube'  # subdirectory of year partition where cube is stored
+MONTH = 'mesiac'  # month dimension of cube
+COUNT = 'pocet nehod'  # number of crashes in group
+CUBE_COLUMNS = ['zavinenie nehody', 'stav povrchu vozovky v dobe nehody']  # code columns dimensions of cube
+CUBE_SUMS = ['usmrtenych osob', 'tazko zranenych osob', 'lahko zranenych osob']  # columns summed in cube
+GRID = 'grid'  # subdirectory of year partition where grid pyramid of crash locations is stored
+CELL = 'bunka'  # key of grid cell, it holds level, row and column of cell (see cell_keys)
+GRID_ORIGIN = (-910000, -1240000)  # S-JTSK corner (gps_x, gps_y) of grid, cells of all partitions are aligned
+GRID_SIZES = [100 << level for level in range(9)]  # side of cell in metres at every level of pyramid, 100 m - 25.6 km
+GRID_CELLS = 4096  # default maximum of cells covering viewport, the finest level within it is queried
+CELL_BITS = 20  # bits of row and of column in key of cell
+
+CHUNK_SIZE = 1 << 22  # bytes of csv file read and parsed at once
+RAW_LEN = C_LEN - 2  # number of columns in csv file, date and time are split into 2 columns each
+
+# bytes with special meaning in csv file
+QUOTE, DELIMITER, NEWLINE, CR = ord('"'), ord(';'), ord('\n'), ord('\r')
+
+# unicode code point of every byte in ISO-8859-2, used to decode whole columns of bytes at once
+ISO_8859_2 = np.frombuffer(bytes(range(256)).decode('ISO-8859-2').encode('utf-32-le'), dtype=np.uint32)
+
+
+def split_fields(buf):
+    """ Finds start and length of every field in csv file at once.
+
+    Delimiters and newlines inside quotes are ignored (quotes are counted by cumulative xor), quotes around fields
+    are stripped and empty lines are skipped.
+    :param buf: numpy array of bytes of csv file
+    :return: tuple of 2D numpy arrays (rows x columns of csv file) with starts and lengths of fields
+    """
+    if buf.shape[0] and buf[-1] != NEWLINE:
+        buf = np.append(buf, np.uint8(NEWLINE))
+    if not buf.shape[0]:
+        return np.empty((0, RAW_LEN), dtype=int), np.empty((0, RAW_LEN), dtype=int)
+
+    inside = np.bitwise_xor.accumulate((buf == QUOTE).view(np.uint8)).view(bool)  # inside of quoted field
+    ends = np.flatnonzero(((buf == DELIMITER) | (buf == NEWLINE)) & ~inside)
+    is_newline = buf[ends] == NEWLINE
+
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    ends = ends - (is_newline & (ends > starts) & (buf[ends - 1] == CR))  # newline could be '\r\n'
+
+    # skip empty lines, they are one empty field after previous newline
+    empty = is_newline & (starts == ends) & np.concatenate(([True], is_newline[:-1]))
+    starts, ends, is_newline = starts[~empty], ends[~empty], is_newline[~empty]
+
+    rows = starts.shape[0] // RAW_LEN
+    if starts.shape[0] != rows * RAW_LEN or np.count_nonzero(is_newline) != rows \
+            or not is_newline.reshape(rows, RAW_LEN)[:, -1].all():
+        raise ValueError(f'every row of csv file has to have {RAW_LEN} columns')
+
+    # strip quotes around fields
+    lengths = ends - starts
+    quoted = (lengths >= 2) & (buf[starts] == QUOTE) & (buf[np.maximum(ends - 1, 0)] == QUOTE)
+    starts = starts + quoted
+    lengths = lengths - 2 * quoted
+
+    return starts.reshape(rows, RAW_LEN), lengths.reshape(rows, RAW_LEN)
+
+
+def field_matrix(buf, starts, lengths):
+    """ Copies fields into 2D array of bytes padded with zeros, every row is one field.
+
+    :param buf: numpy array of bytes of csv file, padded with zeros at least to the longest field
+    :param starts: numpy array with starts of fields
+    :param lengths: numpy array with lengths of fields
+    :return: 2D numpy array of bytes
+    """
+    width = max(int(lengths.max(initial=0)), 1)
+    offsets = np.arange(width, dtype=starts.dtype)
+    matrix = buf[starts[:, None] + offsets]
+    matrix[offsets >= lengths[:, None]] = 0
+    return matrix
+
+
+def convert_unique(values, dtype, nan):
+    """ Converts strings to numbers one by one, values with invalid data type are replaced by "my NaN number".
+
+    Used only for few cells, which could not be converted at once. Only unique values are converted.
+    :param values: numpy array of strings
+    :param dtype: data type of result
+    :param nan: value used for values which can not be converted
+    :return: numpy array of numbers
+    """
+    unique, inverse = np.unique(values, return_inverse=True)
+    converted = np.empty(unique.shape[0], dtype=dtype)
+    for i, value in enumerate(unique):
+        try:
+            converted[i] = value
+        except ValueError:
+            converted[i] = nan
+    return converted[inverse]
+
+
+def decode_strings(matrix):
+    """ Decodes 2D array of ISO-8859-2 bytes into array of unicode strings.
+
+    :param matrix: 2D numpy array of bytes (see field_matrix)
+    :return: numpy array of strings
+    """
+    codes = np.ascontiguousarray(ISO_8859_2[matrix])
+    strings_arr = codes.view(f'<U{matrix.shape[1]}').reshape(matrix.shape[0])
+    if (matrix == QUOTE).any():
+        strings_arr = np.char.replace(strings_arr, '""', '"')  # escaped quotes inside quoted field
+    return strings_arr
+
+
+def parse_ints(matrix, nan):
+    """ Converts 2D array of bytes to integers digit by digit for whole column at once.
+
+    Empty cells and cells which are not integers are replaced by "my NaN number".
+    :param matrix: 2D numpy array of bytes (see field_matrix)
+    :param nan: "my NaN number"
+    :return: numpy array of integers
+    """
+    converted = np.zeros(matrix.shape[0], dtype=int)
+    valid = np.ones(matrix.shape[0], dtype=bool)
+    for i in range(matrix.shape[1]):
+        digit = matrix[:, i].astype(int) - ord('0')
+        present = matrix[:, i] != 0
+        valid &= ~present | ((digit >= 0) & (digit <= 9))
+        converted = np.where(present, converted * 10 + digit, converted)
+    if matrix.shape[1] > 18:
+        valid &= matrix[:, 18] == 0  # longer numbers overflow
+
+    empty = matrix[:, 0] == 0
+    converted[empty] = nan
+
+    # for example negative numbers or numbers with spaces
+    rest = np.flatnonzero(~valid & ~empty)
+    if rest.shape[0]:
+        converted[rest] = convert_unique(decode_strings(matrix[rest]), int, nan)
+    return converted
+
+
+def parse_floats(matrix, nan):
+    """ Converts 2D array of bytes with decimal comma to floats for whole column at once.
+
+    Empty cells and cells which are not numbers are replaced by "my NaN number".
+    :param matrix: 2D numpy array of bytes (see field_matrix)
+    :param nan: "my NaN number"
+    :return: numpy array of floats
+    """
+    matrix = np.where(matrix == ord(','), ord('.'), matrix).astype(np.uint8)
+    values = np.ascontiguousarray(matrix).view(f'S{matrix.shape[1]}').reshape(matrix.shape[0])
+
+    converted = np.full(matrix.shape[0], nan, dtype=float)
+    filled = np.flatnonzero(matrix[:, 0] != 0)
+    try:
+        converted[filled] = values[filled].astype(float)
+    except ValueError:
+        converted[filled] = convert_unique(decode_strings(matrix[filled]), float, nan)
+    return converted
+
+
+def frame_rows(columns):
+    """ Returns number of rows of list of columns (numpy arrays or EncodedColumn). """
+    return columns[0].shape[0] if columns else 0
+
+
+@instrument.traced(rows=frame_rows)
+def parse_csv(data, nan):
+    """ Parses whole csv file with crashes into columns with correct values and data types.
+
+    Whole file is processed at once as array of bytes, every column is converted at once. Date and time are formatted
+    separately (year as new column, date changed to only month-day value, time divided into hours and minutes where
+    25 is unknown hour and 60 is unknown minute). Values with invalid data type are replaced by "my NaN number".
+    :param data: bytes of csv file
+    :param nan: "my NaN number" for integers and floats
+    :return: list of numpy arrays where every array is one column
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts, lengths = split_fields(buf)
+    buf = np.concatenate((buf, np.zeros(int(lengths.max(initial=0)) + 2, dtype=np.uint8)))  # padding for field_matrix
+    fields = [(starts[:, i], lengths[:, i]) for i in range(RAW_LEN)]
+
+    # date formatting, split date on first '-'
+    date_start, date_len = fields[3]
+    dash = field_matrix(buf, date_start, date_len) == ord('-')
+    dash_pos = np.where(dash.any(axis=1), dash.argmax(axis=1), date_len)
+    year = (date_start, dash_pos)
+    m_d = (date_start + dash_pos + 1, np.maximum(date_len - dash_pos - 1, 0))
+
+    # time formatting, time 'HHMM' is divided into hours, minutes
+    time_start, time_len = fields[5]
+    hours = (time_start, np.minimum(time_len, 2))
+    minutes = (time_start + 2, np.maximum(time_len - 2, 0))
+
+    fields = [*fields[:3], year, m_d, fields[4], hours, minutes, *fields[6:]]
+
+    data_list = []
+    for i, (start, length) in enumerate(fields):
+        matrix = field_matrix(buf, start, length)
+        if i in strings:
+            data_list.append(decode_strings(matrix).astype('<U32'))
+        elif i in floats:
+            data_list.append(parse_floats(matrix, nan))
+        else:
+            data_list.append(parse_ints(matrix, nan))
+
+    data_list[6][data_list[6] >= 25] = nan  # 25 is unknown time for hours
+    data_list[7][data_list[7] >= 60] = nan  # 60 is unknown time for minutes
+    return data_list
+
+
+def read_csv(csv_raw, nan, chunk_size=CHUNK_SIZE):
+    """ Reads csv file in one pass by chunks of whole rows and parses every chunk (see parse_csv).
+
+    Chunk is cut after last newline which is not inside quotes, the rest of chunk is prepended to the next one.
+    :param csv_raw: binary file object of csv file from zip
+    :param nan: "my NaN number" for integers and floats
+    :param chunk_size: number of bytes read at once
+    :return: generator of lists of numpy arrays where every array is one column of chunk
+    """
+    rest = b''
+    parsed = False
+    while True:
+        with instrument.span('inflate'):  # zip decompression
+            data = csv_raw.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+
+        end = data.rfind(b'\n')
+        while end != -1 and data.count(b'"', 0, end) % 2:
+            end = data.rfind(b'\n', 0, end)  # newline inside quoted field
+        rest = data[end + 1:]
+
+        if end != -1:
+            parsed = True
+            yield parse_csv(data[:end + 1], nan)
+
+    if rest or not parsed:
+        yield parse_csv(rest, nan)
+
+
+class ColumnBuffer:
+    """ Growable buffers for columns, filled by chunks of rows and trimmed to number of rows at the end. """
+
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.size = 0
+        self.columns = None
+
+    def append(self, columns):
+        """ Appends chunk of rows, capacity of buffers is doubled when they are full.
+
+        :param columns: list of numpy arrays where every array is one column
+        """
+        rows = columns[0].shape[0]
+        if self.columns is None:
+            self.capacity = max(self.capacity, rows)
+            self.columns = [np.empty(self.capacity, dtype=column.dtype) for column in columns]
+
+        if self.size + rows > self.capacity:
+            self.capacity = max(2 * self.capacity, self.size + rows)
+            for column in self.columns:
+                column.resize(self.capacity, refcheck=False)
+
+        for buffer, column in zip(self.columns, columns):
+            buffer[self.size:self.size + rows] = column
+        self.size += rows
+
+    def trim(self):
+        """ Trims buffers to number of appended rows.
+
+        :return: list of numpy arrays where every array is one column, empty list if nothing was appended
+        """
+        if self.columns is None:
+            return []
+        for column in self.columns:
+            column.resize(self.size, refcheck=False)
+        self.capacity = self.size
+        return self.columns
+
+
+def archive_key(path):
+    """ Returns key ordering zips from the oldest data to the newest, zip with whole year is newer than monthly zips
+    of the same year ('datagis-09-2020.zip' < 'datagis-rok-2020.zip' < 'datagis2021.zip').
+
+    :param path: path to zip file
+    :return: tuple of year, month (13 for whole year) and name, unknown names are the oldest
+    """
+    name = os.path.basename(path)
+    match = re.match('datagis-([0-9]{2})-([0-9]{4})\\.zip$', name)
+    if match:
+        return int(match.group(2)), int(match.group(1)), name
+    match = re.match('datagis(?:-rok-)?([0-9]{4})\\.zip$', name)
+    if match:
+        return int(match.group(1)), 13, name
+    return 0, 0, name
+
+
+def last_unique(ids, ranks, empty=''):
+    """ Finds rows with unique ID, from rows with the same ID the one with the highest rank is kept.
+
+    Rows with empty ID are always kept.
+    :param ids: numpy array of IDs (or of their keys, see id_keys)
+    :param ranks: numpy array of ranks of rows (rank of zip the row comes from)
+    :param empty: empty ID (or its key)
+    :return: sorted numpy array of indexes of kept rows
+    """
+    order = np.lexsort((ranks, ids))
+    ids = ids[order]
+    last = np.ones(ids.shape[0], dtype=bool)
+    last[:-1] = ids[1:] != ids[:-1]
+    return np.sort(order[last | (ids == empty)])
+
+
+def id_keys(ids):
+    """ Returns 64-bit hashes of IDs, 8 bytes per row instead of 128 bytes of '<U32' string.
+
+    :param ids: numpy array of IDs
+    :return: numpy array of uint64 keys
+    """
+    return pd.util.hash_array(np.asarray(ids).astype(object))
+
+
+EMPTY_KEY = id_keys(np.array(['']))[0]  # key of empty ID
+
+
+def months_of(column):
+    """ Extracts months from 'mesiac-den' column (values 'MM-DD'), invalid months are 0.
+
+    Only unique values are converted, so it is fast also for dictionary-encoded column.
+    :param column: numpy array of strings or EncodedColumn
+    :return: numpy array of months
+    """
+    values, inverse = np.unique(np.asarray(column), return_inverse=True)
+    months = np.zeros(values.shape[0], dtype=np.int8)
+    for i, value in enumerate(values):
+        months[i] = int(value[:2]) if value[:2].isdigit() else 0
+    return months[inverse.reshape(-1)]
+
+
+def read_member(zip_file, csv_file, nan, buffer):
+    """ Streams csv file from zip into column buffer.
+
+    :param zip_file: path to zip file
+    :param csv_file: name of csv file in zip
+    :param nan: "my NaN number" for integers and floats
+    :param buffer: ColumnBuffer where parsed rows are appended
+    """
+    with instrument.span('read_member', zip=os.path.basename(zip_file), csv=csv_file) as span:
+        rows = buffer.size
+        with ZipFile(zip_file) as zf:
+            with zf.open(csv_file, "r") as csv_raw:
+                for chunk in read_csv(csv_raw, nan):
+                    buffer.append(chunk)
+        span.set(rows=buffer.size - rows)
+
+
+def parse_zip(zip_file, csv_file, nan):
+    """ Parses csv file from zip into columns.
+
+    :param zip_file: path to zip file
+    :param csv_file: name of csv file in zip
+    :param nan: "my NaN number" for integers and floats
+    :return: tuple of number of rows and list of numpy arrays where every array is one column
+    """
+    buffer = ColumnBuffer()
+    read_member(zip_file, csv_file, nan, buffer)
+    return buffer.size, buffer.trim()
+
+
+def parse_shared(zip_file, csv_file, nan):
+    """ Parses csv file from zip in worker process and writes every column into its own shared memory block.
+
+    Columns are compacted before they are written (see compact), strings with few unique values are written as codes
+    and their dictionary is returned directly, so shared memory holds about as much as disk cache and not '<U32'
+    strings. Blocks are not unlinked here, parent process frees them in assemble_parts.
+    :param zip_file: path to zip file
+    :param csv_file: name of csv file in zip
+    :param nan: "my NaN number" for integers and floats
+    :return: tuple of number of rows and list of (shared memory name, data type, dictionary or None) for every column
+    """
+    rows, columns = parse_zip(zip_file, csv_file, nan)
+
+    blocks = []
+    for column in columns:
+        column = compact(column)
+        dictionary = None
+        if isinstance(column, EncodedColumn):
+            column, dictionary = column.codes, column.dictionary
+        shm = shared_memory.SharedMemory(create=True, size=max(column.nbytes, 1))
+        np.ndarray(column.shape, dtype=column.dtype, buffer=shm.buf)[:] = column
+        blocks.append((shm.name, column.dtype.str, dictionary))
+        # parent process takes over the block, it registers it again when attaching and unregisters it when unlinking
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+    return rows, blocks
+
+
+def assemble_parts(parts):
+    """ Concatenates parts of columns, columns written into shared memory by workers (see parse_shared) are freed.
+
+    :param parts: list of tuples of number of rows and list of columns, column is either numpy array or
+                  (shared memory name, data type, dictionary or None)
+    :return: list of numpy arrays where every array is one column
+    """
+    def dtype_of(column):
+        if not isinstance(column, tuple):
+            return column.dtype
+        return column[1] if column[2] is None else column[2].dtype
+
+    total = sum(rows for rows, _ in parts)
+    columns = []
+    if parts:
+        # parts can be compacted into different types (e.g. shorter strings or narrower integers)
+        columns = [np.empty(total, dtype=np.result_type(*(dtype_of(part[i]) for _, part in parts)))
+                   for i in range(len(parts[0][1]))]
+
+    offset = 0
+    for rows, part in parts:
+        for column, part_column in zip(columns, part):
+            if not isinstance(part_column, tuple):
+                column[offset:offset + rows] = part_column
+                continue
+            shm = shared_memory.SharedMemory(name=part_column[0])
+            try:
+                values = np.ndarray(rows, dtype=part_column[1], buffer=shm.buf)
+                column[offset:offset + rows] = values if part_column[2] is None else part_column[2][values]
+            finally:
+                shm.close()
+                shm.unlink()
+        offset += rows
+    return columns
+
+
+def cell_keys(level, rows, cols):
+    """ Returns keys of grid cells, keys are sorted by level, row and column of cell.
+
+    :param level: level of pyramid (index to GRID_SIZES)
+    :param rows: numpy array of rows of cells (from south)
+    :param cols: numpy array of columns of cells (from west)
+    :return: numpy array of int64 keys
+    """
+    return (np.int64(level) << 2 * CELL_BITS) | (np.asarray(rows, dtype=np.int64) << CELL_BITS) | cols
+
+
+def cell_range(bounds, size):
+    """ Returns columns and rows of cells covering bounding box, clipped to grid.
+
+    :param bounds: tuple of minimal gps_x, minimal gps_y, maximal gps_x and maximal gps_y (S-JTSK metres)
+    :param size: side of cell in metres
+    :return: tuple of the first column, the first row, the last column and the last row
+    """
+    last = (1 << CELL_BITS) - 1
+    minx, miny, maxx, maxy = bounds
+    c0, c1 = (min(max(int((x - GRID_ORIGIN[0]) // size), 0), last) for x in (minx, maxx))
+    r0, r1 = (min(max(int((y - GRID_ORIGIN[1]) // size), 0), last) for y in (miny, maxy))
+    return c0, r0, c1, r1
+
+
+def grid_level(bounds, max_cells=GRID_CELLS):
+    """ Returns the finest level of pyramid whose cells covering bounding box are at most max_cells.
+
+    :param bounds: tuple of minimal gps_x, minimal gps_y, maximal gps_x and maximal gps_y (S-JTSK metres)
+    :param max_cells: maximal number of cells covering bounding box
+    :return: level of pyramid, the coarsest level if even its cells are too many
+    """
+    for level, size in enumerate(GRID_SIZES):
+        c0, r0, c1, r1 = cell_range(bounds, size)
+        if (c1 - c0 + 1) * (r1 - r0 + 1) <= max_cells:
+            return level
+    return len(GRID_SIZES) - 1
+
+
+def grid_meta():
+    """ Returns metadata of grid pyramid stored in disk cache, cache with other grid is built again. """
+    return {'origin': list(GRID_ORIGIN), 'sizes': GRID_SIZES}
+
+
+class CubePart:
+    """ Columns of cube (or grid pyramid) of one year partition, stored in memory cache as one value. """
+
+    def __init__(self, columns):
+        self.columns = columns  # column header -> numpy array
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+
+def rebatch(pieces, batch_size):
+    """ Regroups pieces of rows into batches with fixed number of rows, only the last batch can be smaller.
+
+    :param pieces: iterable of lists of columns (numpy arrays or EncodedColumn), pieces can have any number of rows
+    :param batch_size: number of rows in batch
+    :return: generator of lists of columns
+    """
+    pending, size = [], 0
+    for piece in pieces:
+        rows = piece[0].shape[0] if piece else 0
+        offset = 0
+        while rows - offset >= batch_size - size:
+            stop = offset + batch_size - size
+            pending.append([column[offset:stop] for column in piece])
+            yield pending[0] if len(pending) == 1 else [concat_parts(list(column)) for column in zip(*pending)]
+            pending, size, offset = [], 0, stop
+        if offset < rows:
+            pending.append([column[offset:] for column in piece])
+            size += rows - offset
+    if size:
+        yield pending[0] if len(pending) == 1 else [concat_parts(list(column)) for column in zip(*pending)]
 
 
 class DataDownloader:
     """ Class for downloading data, formatting them and storing into memory/cache. """
 
-    def __init__(self, url='https://ehw.fit.vutbr.cz/izv/', folder='data', cache_filename='data_{}.pkl.gz',
-                 header=None):
+    def __init__(self, url='https://ehw.fit.vutbr.cz/izv/', folder='data', cache_filename='data_{}',
+                 header=None, download_workers=4, listing_ttl=3600, offline=False, cache_bytes=1 << 30):
 
-        if header is None:
-            self.header = HEADER
+        self.header = HEADER if header is None else header
         self.url = url
         self.folder = f"./{folder}"
         self.cache_file = cache_filename
@@ -69,174 +590,763 @@ class DataDownloader:
                              'LBK': ('18', '18.csv'), 'KVK': ('19', '19.csv')}
 
         self.int_nan = -99999  # NaN for integers
-        self.cache = {}
+        # (region, year, build, column name) -> column, see partition_key
+        self.cache = LRUCache(cache_bytes, sizeof=lambda column: column.nbytes)
+        self.indexes = {}  # (region, year, build) -> tuple of pandas Index of IDs and row positions of these IDs
         self.download_regex = re.compile('data/datagis([0-9]{4}|-rok-[0-9]{4})\\.zip')  # only files with year data
+        self.download_workers = download_workers  # number of zips downloaded at once
+        self.listing_ttl = listing_ttl  # seconds for which list of zips on server is considered up to date
+        self.offline = offline  # never touch network, use only zips in folder
 
+    @instrument.traced()
     def download_data(self):
         """Downloads data from url.
 
         Create directory where to store the data and download last zip of every year into it. Using BeautifoulSoup and
-        regex to find correct zips in html.
+        regex to find correct zips in html. Zips are downloaded concurrently, partially downloaded zips are resumed and
+        already downloaded zips are only revalidated on server (see Fetcher).
+
+        Names of zips are stored into manifest with time of listing, the server is not contacted again until listing is
+        older than listing_ttl or some listed zip is missing. It is called before every read of cached data, so long
+        living instance sees zips published later, with fresh listing it only reads manifest. In offline mode only zips
+        already present in folder are used.
         :return: None
         """
+        if self.offline:
+            if not self.zip_files():
+                raise FileNotFoundError(f'offline mode: no zip files in {self.folder}')
+            return
+
         if not os.path.exists(self.folder):
             os.mkdir(self.folder)
 
-        # find names of zip files to download
-        s = requests.session()
-        doc = s.get('https://ehw.fit.vutbr.cz/izv/', headers=self.header).text
+        fetcher = Fetcher(self.folder, header=self.header, workers=self.download_workers)
+        listing = fetcher.manifest.get('listing', {})
+        names = listing.get('names', [])
+
+        fresh = listing.get('url') == self.url and time.time() - listing.get('time', 0) < self.listing_ttl
+        complete = all(os.path.exists(f'{self.folder}/{name.split("/")[-1]}') for name in names)
+        if not (fresh and complete and names):
+            if not fresh:
+                names = self.list_zips()
+                fetcher.manifest['listing'] = {'url': self.url, 'time': time.time(), 'names': names}
+            fetcher.fetch([f'{self.url}{name}' for name in names])
+
+    def list_zips(self):
+        """ Finds names of zip files to download on server.
+
+        :return: list of names of zips matching regex for year data zip file and last month available
+        """
+        doc = requests.get(self.url, headers=self.header).text
         soup = BeautifulSoup(doc, 'html.parser')
         zip_names = [item.get('href') for item in soup.find_all("a", {"class": "btn btn-sm btn-primary"})]
 
-        # download zips when matching regex for year data zip file
-        for name in zip_names:
-            if self.download_regex.match(name) and not os.path.exists(f'{self.folder}/{name.split("/")[-1]}'):
-                r = s.get(f'https://ehw.fit.vutbr.cz/izv/{name}', headers=self.header)
-                with open(f'{self.folder}/{name.split("/")[-1]}', 'wb') as f:
-                    f.write(r.content)
+        names = [name for name in zip_names if self.download_regex.match(name)]
+        if zip_names and zip_names[-1] not in names:
+            names.append(zip_names[-1])
+        return names
 
-        # download last month available if it is not already downloaded
-        if not os.path.exists(f'{self.folder}/{zip_names[-1].split("/")[-1]}'):
-            r = s.get(f'https://ehw.fit.vutbr.cz/izv/{zip_names[-1]}', headers=self.header)
-            with open(f'{self.folder}/{zip_names[-1].split("/")[-1]}', 'wb') as f:
-                f.write(r.content)
+    def zip_files(self):
+        """ Returns paths of downloaded zips in order in which their data are concatenated, the newest zip is last. """
+        return sorted(glob.glob(self.folder + '/*.zip'), key=archive_key)
 
+    @instrument.traced()
+    def build_regions(self, regions, workers=None):
+        """ Builds disk cache of regions, only zips which are new or changed since the last build are parsed.
+
+        Disk cache of region is partitioned by years, rows in year partition are sorted by month (and zip), so every
+        month is a range of rows. For every region it is recorded which zips (with content hashes) and years its disk
+        cache was built from. Only year partitions containing rows of new, changed or removed zips are rebuilt, rows of
+        unchanged zips are taken from old partition and rows of new or changed zips are spliced in. Rows with the same
+        ID (accidents in overlapping zips) are stored only once, from the newest zip. Unchanged zips are parsed again
+        only if a zip with some of their duplicates was changed or removed. With more workers
+        every (zip, region) pair is parsed in process pool, workers return columns in shared memory blocks, so large
+        numpy arrays are not pickled. Workers compact columns before writing them, and at most two tasks per worker
+        are submitted ahead of the (region, zip) pair assembled by this process, so shared memory holds only a few
+        parsed csv files at once. Built columns are stored into disk cache and memory.
+        :param regions: list of regions to build
+        :param workers: number of worker processes, zips are parsed in this process if not set
+        """
+        self.download_data()
+        zip_files = self.zip_files()
+        sources = self.sources()
+
+        # (region, zip) pairs to parse in order in which they are assembled
+        order = []
+        for reg in regions:
+            meta = self.region_meta(reg)
+            old_sources = meta.get('sources', {})
+            old_years = meta.get('years', {})
+
+            # years in which rows of changed or removed zips could hide duplicates of unchanged zips
+            replaced = {year for name, years in old_years.items() if sources.get(name) != old_sources[name]
+                        for year in years if meta.get('duplicates', {}).get(str(year))}
+
+            for zip_file in zip_files:
+                name = os.path.basename(zip_file)
+                if old_sources.get(name) != sources[name] or replaced.intersection(old_years.get(name, [])):
+                    order.append((reg, zip_file))
+
+        pool = ProcessPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+        window = 2 * workers if pool else 0
+        tasks = {}  # index to order -> task which was submitted and not assembled yet
+
+        def submit(i):
+            if i < len(order):
+                reg_i, zip_i = order[i]
+                tasks[i] = pool.submit(parse_shared, zip_i, self.region_codes[reg_i][1], self.int_nan)
+
+        for i in range(window):
+            submit(i)
+        try:
+            i = 0
+            for reg in regions:
+                parsed = {}
+                while i < len(order) and order[i][0] == reg:
+                    zip_file = order[i][1]
+                    if pool:
+                        part = tasks.pop(i).result()
+                        submit(i + window)
+                    else:
+                        part = parse_zip(zip_file, self.region_codes[reg][1], self.int_nan)
+                    parsed[os.path.basename(zip_file)] = assemble_parts([part])
+                    i += 1
+                self.build_region(reg, zip_files, sources, parsed)
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+                # free shared memory of tasks which were not assembled because of error
+                for task in tasks.values():
+                    if not task.cancelled() and task.exception() is None:
+                        assemble_parts([task.result()])
+
+    @instrument.traced()
+    def build_region(self, region, zip_files, sources, parsed):
+        """ Rebuilds year partitions of region affected by parsed zips and zips which were removed.
+
+        :param region: region code
+        :param zip_files: paths of current zips
+        :param sources: content hashes of current zips
+        :param parsed: dictionary mapping names of new or changed zips (or zips which are parsed again) to their parsed
+                       columns (without region)
+        """
+        path = self.cache_path(region)
+        meta = self.region_meta(region)
+        names = [os.path.basename(zip_file) for zip_file in zip_files]
+        unchanged = [name for name in names if name not in parsed]
+
+        years = {name: meta['years'][name] for name in unchanged}
+        for name, columns in parsed.items():
+            years[name] = np.unique(columns[3]).tolist() if columns else []
+
+        # years with rows from new, changed or removed zips
+        affected = {year for name in parsed for year in years[name]}
+        affected |= {year for name, old in meta.get('years', {}).items() if name not in unchanged for year in old}
+        partitions = {int(year): months for year, months in meta.get('partitions', {}).items()}
+        duplicates = {int(year): count for year, count in meta.get('duplicates', {}).items()}
+        builds = {int(year): build for year, build in meta.get('builds', {}).items()}
+        rank = {name: i for i, name in enumerate(names)}
+
+        if meta.get('layout') != LAYOUT and os.path.exists(path):
+            shutil.rmtree(path)  # disk cache in older format
+        os.makedirs(path, exist_ok=True)
+
+        data_header = ['region'] + COLUMNS
+        for year in sorted(affected):
+            parts, part_sources = [], []
+
+            # rows of unchanged zips from old partition
+            if year in partitions:
+                columns = store.load_columns(os.path.join(path, str(year)))[1]
+                rows = np.flatnonzero(isin(columns[-1], unchanged))
+                parts.append([np.asarray(column[rows]).astype(types[i]) for i, column in enumerate(columns[1:-1])])
+                part_sources.append(np.asarray(columns[-1][rows]))
+
+            # rows of new or changed zips
+            for name, columns in parsed.items():
+                if columns:
+                    rows = np.flatnonzero(columns[3] == year)
+                    parts.append([column[rows] for column in columns])
+                    part_sources.append(np.full(rows.shape[0], name))
+
+            columns = [np.concatenate(column) for column in zip(*parts)]
+            source = np.concatenate(part_sources) if part_sources else np.empty(0, dtype=str)
+            self.indexes.pop((region, year, builds.pop(year, None)), None)
+            if not source.shape[0]:
+                partitions.pop(year, None)
+                duplicates.pop(year, None)
+                continue
+
+            # accidents from overlapping zips, only row from the newest zip is kept
+            sources_unique, source_codes = np.unique(source, return_inverse=True)
+            ranks = np.array([rank[name] for name in sources_unique])[source_codes.reshape(-1)]
+            kept = last_unique(columns[0], ranks)
+            duplicates[year] = int(source.shape[0] - kept.shape[0])
+
+            # sort by months, rows of one month are in order of zips
+            month = months_of(columns[4][kept])
+            order = kept[np.lexsort((ranks[kept], month))]
+            month = np.sort(month)
+            partitions[year] = [[int(m), int(np.searchsorted(month, m, 'left')),
+                                 int(np.searchsorted(month, m, 'right'))] for m in np.unique(month)]
+
+            final_data = [np.full(source.shape[0], region, dtype='<U3')] + [column[order] for column in columns]
+            final_data = [compact(column) for column in final_data + [source[order]]]
+            store.save_columns(os.path.join(path, str(year)), data_header + [SOURCE], final_data)
+            self.save_cube(os.path.join(path, str(year), CUBE), month, dict(zip(data_header, final_data)))
+            self.save_grid(os.path.join(path, str(year), GRID), dict(zip(data_header, final_data)))
+            builds[year] = uuid.uuid4().hex  # columns of older builds in memory cache are not used anymore
+            for name, column in zip(data_header, final_data):
+                self.cache.put((region, year, builds[year], name), column)
+
+        store.write_json(os.path.join(path, store.META), {
+            'layout': LAYOUT, 'header': data_header, 'cube': CUBE_COLUMNS + CUBE_SUMS, 'grid': grid_meta(),
+            'sources': sources,
+            'years': years,
+            'partitions': {str(year): months for year, months in sorted(partitions.items())},
+            'duplicates': {str(year): count for year, count in sorted(duplicates.items())},
+            'builds': {str(year): build for year, build in sorted(builds.items())}})
+
+        # remove partitions which are not used anymore
+        for entry in os.listdir(path):
+            if entry.lstrip('-').isdigit() and int(entry) not in partitions:
+                shutil.rmtree(os.path.join(path, entry))
+
+    def save_cube(self, path, month, data):
+        """ Aggregates rows of year partition into cube and stores it, "my NaN number" is not summed.
+
+        :param path: directory where cube is stored
+        :param month: numpy array with month of every row
+        :param data: dictionary mapping column headers to columns of year partition
+        """
+        weights = [np.where(data[name] == self.int_nan, 0, data[name]) for name in CUBE_SUMS]
+        keys, counts, sums = group_by([month] + [data[name] for name in CUBE_COLUMNS], weights)
+        store.save_columns(path, [MONTH] + CUBE_COLUMNS + [COUNT] + CUBE_SUMS,
+                           [compact(column) for column in keys + [counts] + sums])
+
+    def save_grid(self, path, data):
+        """ Aggregates crash locations of year partition into grid pyramid and stores it.
+
+        Cells of the finest level are grouped from rows, cells of coarser levels are grouped from cells of the finest
+        level (side of cell is doubled by every level). Rows with unknown coordinates or out of grid are skipped,
+        "my NaN number" is not summed. Cells are stored sorted by keys, so cells of one row of viewport are one slice.
+        :param path: directory where pyramid is stored
+        :param data: dictionary mapping column headers to columns of year partition
+        """
+        x, y = np.asarray(data['gps_x']), np.asarray(data['gps_y'])
+        known = (x != self.int_nan) & (y != self.int_nan) & ~np.isnan(x) & ~np.isnan(y)
+        cols = np.floor((x[known] - GRID_ORIGIN[0]) / GRID_SIZES[0]).astype(np.int64)
+        rows = np.floor((y[known] - GRID_ORIGIN[1]) / GRID_SIZES[0]).astype(np.int64)
+        inside = (cols >= 0) & (cols < 1 << CELL_BITS) & (rows >= 0) & (rows < 1 << CELL_BITS)
+        weights = [np.where(data[name] == self.int_nan, 0, data[name])[known][inside] for name in CUBE_SUMS]
+
+        (keys,), counts, sums = group_by([cell_keys(0, rows[inside], cols[inside])], weights)
+        levels = [[keys, counts] + sums]
+        rows, cols = keys >> CELL_BITS & (1 << CELL_BITS) - 1, keys & (1 << CELL_BITS) - 1
+        for level in range(1, len(GRID_SIZES)):
+            (level_keys,), _, level_sums = group_by([cell_keys(level, rows >> level, cols >> level)], [counts] + sums)
+            levels.append([level_keys] + level_sums)
+
+        store.save_columns(path, [CELL, COUNT] + CUBE_SUMS,
+                           [compact(np.concatenate(column)) for column in zip(*levels)])
+
+    def partition_key(self, region, year, meta=None):
+        """ Returns key of year partition in memory cache, it changes whenever partition is rebuilt (by any instance
+        or process), so columns of older builds are never used.
+
+        :param region: region code
+        :param year: year of partition
+        :param meta: already read metadata of region, read from disk if not given
+        :return: tuple of region, year and build id of partition
+        """
+        meta = self.region_meta(region) if meta is None else meta
+        return region, year, meta.get('builds', {}).get(str(year))
+
+    def aggregate_part(self, region, year, name, meta=None):
+        """ Returns cube or grid pyramid of year partition, it is kept in memory cache.
+
+        :param region: region code
+        :param year: year of partition
+        :param name: CUBE or GRID
+        :param meta: already read metadata of region, read from disk if not given
+        :return: CubePart
+        """
+        key = self.partition_key(region, year, meta) + (name,)
+        part = self.cache.get(key)
+        if part is None:
+            header, columns = store.load_columns(os.path.join(self.cache_path(region), str(year), name))
+            part = CubePart(dict(zip(header, (np.asarray(column) for column in columns))))
+            self.cache.put(key, part)
+        return part
+
+    def cube(self, by=None, regions=None, years=None, months=None):
+        """ Aggregates data from precomputed cubes of year partitions, raw rows are not read at all.
+
+        Cube of every year partition is built with disk cache (see build_region), it holds number of crashes and
+        sums of injuries grouped by month and code columns of cube. Queries are grouped again by requested dimensions.
+        :param by: list of dimensions to group by ('region', 'rok', MONTH or CUBE_COLUMNS), one group if not set
+        :param regions: list of regions, all regions if not set
+        :param years: list of years, all years if not set
+        :param months: list of months (1-12), all months if not set
+        :return: tuple of list of column headers (by, COUNT and CUBE_SUMS) and list of numpy arrays sorted by keys
+        """
+        by = [] if by is None else list(by)
+        dimensions = ['region', 'rok', MONTH] + CUBE_COLUMNS
+        unknown = [name for name in by if name not in dimensions]
+        if unknown:
+            raise ValueError(f'unknown dimensions: {unknown}')
+
+        if not regions:
+            regions = self.region_codes.keys()
+
+        if not self.offline:
+            self.download_data()  # newly published zips are found even if regions are cached
+        missing = [reg for reg in regions if not self.region_cached(reg)]
+        if missing:
+            self.build_regions(missing)
+
+        parts = []
+        for reg in regions:
+            meta = self.region_meta(reg)
+            for year in sorted(int(year) for year in meta['partitions']):
+                if years is not None and year not in years:
+                    continue
+                part = dict(self.aggregate_part(reg, year, CUBE, meta).columns)
+                if months is not None and part:
+                    rows = np.isin(part[MONTH], months)
+                    part = {name: column[rows] for name, column in part.items()}
+                rows = part[COUNT].shape[0] if part else 0
+                part['region'] = np.full(rows, reg, dtype='<U3')
+                part['rok'] = np.full(rows, year, dtype=np.int16)
+                if rows:
+                    parts.append(part)
+
+        if parts:
+            data = {name: np.concatenate([part[name] for part in parts]) for name in dimensions + [COUNT] + CUBE_SUMS}
+        else:
+            data = {name: np.empty(0, dtype='<U3' if name == 'region' else np.int64)
+                    for name in dimensions + [COUNT] + CUBE_SUMS}
+
+        keys, _, sums = group_by([data[name] for name in by], [data[name] for name in [COUNT] + CUBE_SUMS])
+        return by + [COUNT] + CUBE_SUMS, keys + sums
+
+    @instrument.traced(rows=len)
+    def cube_dataframe(self, by=None, regions=None, years=None, months=None):
+        """ Returns groups of cube (see cube) as pandas DataFrame, so analysis plots can use it instead of rows.
+
+        Columns are named as in get_dataframe (e.g. 'p16', 'p13a'), 'rok' is 'year', MONTH is 'month' and with both of
+        them 'yyyymm' key is added (-1 is unknown month). Code dimensions with "my NaN number" are nullable integers
+        with missing values, so groupby skips them as it skips missing values of rows. Every group has number of
+        crashes in COUNT column.
+        :param by: list of dimensions to group by ('region', 'rok', MONTH or CUBE_COLUMNS), one group if not set
+        :param regions: list of regions, all regions if not set
+        :param years: list of years, all years if not set
+        :param months: list of months (1-12), all months if not set
+        :return: pandas DataFrame with one row per group
+        """
+        header, columns = self.cube(by, regions, years, months)
+        names = {**NAMES, 'rok': 'year', MONTH: 'month', COUNT: COUNT}
+        frame = {}
+        for name, column in zip(header, columns):
+            if name == 'region':
+                column = pd.Categorical(column)
+            elif name in CUBE_COLUMNS and (column == self.int_nan).any():
+                missing = column == self.int_nan
+                column = pd.arrays.IntegerArray(compact(np.where(missing, 0, column)), missing)
+            frame[names[name]] = column
+        if 'year' in frame and 'month' in frame:
+            valid = frame['month'] > 0
+            frame['yyyymm'] = np.where(valid, frame['year'].astype(np.int32) * 100 + frame['month'], -1).astype(np.int32)
+        return pd.DataFrame(frame)
+
+    @instrument.traced(rows=lambda data: frame_rows(data[2]))
+    def grid(self, bounds, regions=None, years=None, level=None, max_cells=GRID_CELLS):
+        """ Returns cells of grid pyramid visible in viewport, raw rows are not read at all.
+
+        Grid pyramid of every year partition is built with disk cache (see save_grid). Cells of one row of viewport
+        are found by binary search, so query time depends on number of visible cells and not on number of crashes.
+        Cells of all partitions are aligned, cells of the same place are summed.
+        :param bounds: tuple of minimal gps_x, minimal gps_y, maximal gps_x and maximal gps_y (S-JTSK metres, 'd' and
+                       'e' columns of DataFrame)
+        :param regions: list of regions, all regions if not set
+        :param years: list of years, all years if not set
+        :param level: level of pyramid (index to GRID_SIZES), the finest level with at most max_cells cells covering
+                      bounds if not set (see grid_level)
+        :param max_cells: maximal number of cells covering bounds when level is chosen
+        :return: tuple of side of cell in metres, list of column headers ('gps_x', 'gps_y', COUNT and CUBE_SUMS) and
+                 list of numpy arrays, gps_x and gps_y are south-west corners of non-empty cells
+        """
+        level = grid_level(bounds, max_cells) if level is None else level
+        size = GRID_SIZES[level]
+        c0, r0, c1, r1 = cell_range(bounds, size)
+        first = cell_keys(level, np.arange(r0, r1 + 1), c0)
+        last = cell_keys(level, np.arange(r0, r1 + 1), c1)
+
+        if not regions:
+            regions = self.region_codes.keys()
+
+        if not self.offline:
+            self.download_data()  # newly published zips are found even if regions are cached
+        missing = [reg for reg in regions if not self.region_cached(reg)]
+        if missing:
+            self.build_regions(missing)
+
+        names = [CELL, COUNT] + CUBE_SUMS
+        parts = []
+        for reg in regions:
+            meta = self.region_meta(reg)
+            for year in sorted(int(year) for year in meta['partitions']):
+                if years is not None and year not in years:
+                    continue
+                part = self.aggregate_part(reg, year, GRID, meta).columns
+
+                # slice of cells of every row of viewport
+                starts = np.searchsorted(part[CELL], first, 'left')
+                lengths = np.searchsorted(part[CELL], last, 'right') - starts
+                offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                rows = offsets + np.arange(offsets.shape[0])
+                parts.append([part[name][rows] for name in names])
+
+        if parts:
+            columns = [np.concatenate(column) for column in zip(*parts)]
+        else:
+            columns = [np.empty(0, dtype=np.int64) for _ in names]
+        (keys,), _, (counts, *sums) = group_by([columns[0]], columns[1:])
+
+        cell_rows, cell_cols = keys >> CELL_BITS & (1 << CELL_BITS) - 1, keys & (1 << CELL_BITS) - 1
+        return size, ['gps_x', 'gps_y', COUNT] + CUBE_SUMS, \
+            [GRID_ORIGIN[0] + cell_cols * size, GRID_ORIGIN[1] + cell_rows * size, counts] + sums
+
+    @instrument.traced(rows=lambda data: frame_rows(data[1]))
     def parse_region_data(self, region):
         """ Format downloaded data into correct values and data types.
 
         Downloads missing zip files, format data from every year for every region in 'region' variable and stores them
-        into numpy arrays. Every numpy array represents column in csv file.
+        into numpy arrays. Every numpy array represents column in csv file. Columns are converted to compact types,
+        strings with few unique values are dictionary-encoded and integers are stored in the narrowest type.
 
         :param region: list of regions to parse from zips
-        :return: tuple of list of column headers for data and list of numpy arrays where every array is one column
+        :return: tuple of list of column headers for data and list of columns (numpy arrays or EncodedColumn)
         """
         self.download_data()
-        data_list = []
-        final_data = []
+        buffer = ColumnBuffer()
 
         csv_file = self.region_codes.get(region)[1]  # get csv filename based on given region
 
         data_header = COLUMNS.copy()
         data_header.insert(0, 'region')
 
-        # open all zips with year data and read csv files for given region
-        for zip_file in glob.glob(self.folder + '/*.zip'):
-            with ZipFile(zip_file) as zf:
-                with zf.open(csv_file, "r") as csv_raw:
-                    csv_wrap = TextIOWrapper(csv_raw, encoding='ISO-8859-2')
-                    csv_r = csv.reader(csv_wrap, delimiter=';', quotechar='"')
-
-                    rows = len(list(csv_r))  # number of crashes in file
-                    csv_raw.seek(0)
-
-                    # premake numpy arrays with corresponding data types
-                    for r in range(C_LEN):
-                        if r in strings:
-                            data_list.append(np.empty(rows, dtype='<U32'))
-                        elif r in floats:
-                            data_list.append(np.empty(rows, dtype=float))
-                        else:
-                            data_list.append(np.empty(rows, dtype=int))
-
-                    # region array
-                    tmp = np.empty(rows, dtype='<U3')
-                    tmp[:] = region
-
-                    current_row = 0
-                    for row in csv_r:
-                        self.format_line2(row, data_list, current_row)
-                        current_row += 1
-
-                data_list.insert(0, tmp.copy())
-
-                # concat data from all files
-                if not final_data:
-                    final_data = data_list.copy()
-                else:
-                    for i in range(len(data_header)):
-                        final_data[i] = np.concatenate((final_data[i], data_list[i]))
-
-                data_list = []
+        # open all zips with year data and stream csv files for given region into buffers
+        for zip_file in self.zip_files():
+            read_member(zip_file, csv_file, self.int_nan, buffer)
+
+        final_data = buffer.trim()
+        if final_data:
+            final_data.insert(0, np.full(buffer.size, region, dtype='<U3'))  # region array
+        final_data = [compact(column) for column in final_data]
 
         return (data_header, final_data)
 
-    def format_line2(self, data, data_list, j):
-        """ Format one line of data from read file.
+    def cache_path(self, region):
+        """ Returns directory with disk cache of region. """
+        return f'{self.folder}/{self.cache_file.format(region)}'
 
-        Format time and date separately, than store data into pre-made numpy arrays when converting values with invalid
-        data type store "my NaN number".
-        :param data: one row of data from file
-        :param data_list: list of numpy arrays
-        :param j: current row for indexing into numpy arrays
-        :return: None
-        """
-        # time formatting
-        data.insert(6, self.int_nan)  # placeholder because time is divided into hours, minutes
-        time = data[5]
-        data[5] = (lambda x: x if int(x) < 25 else self.int_nan)(time[:2])  # 25 is unknown time  for hours
-        data[6] = (lambda x: x if int(x) < 60 else self.int_nan)(time[2:])  # 60 is unknown time for minutes
+    def sources(self):
+        """ Returns content hashes of downloaded zips, disk cache is valid only for zips it was built from. """
+        return store.source_hashes(self.zip_files(), self.folder)
 
-        # date formatting
-        year, m_d = data[3].split('-', 1)
+    def region_meta(self, region):
+        """ Reads metadata of disk cache of region.
 
-        data.insert(3, year)  # insert year as new column
-        data[4] = m_d  # change date to only month-day value
+        :param region: region code
+        :return: dictionary with metadata, empty if there is no disk cache (or it has older format, other cube or grid)
+        """
+        meta = store.read_meta(self.cache_path(region))
+        if meta is None or meta.get('layout') != LAYOUT or meta.get('header') != ['region'] + COLUMNS \
+                or meta.get('cube') != CUBE_COLUMNS + CUBE_SUMS or meta.get('grid') != grid_meta():
+            return {}
+        return meta
 
-        for i in floats:
-            try:
-                data_list[i][j] = data[i].replace(',', '.')
-            except ValueError:
-                data_list[i][j] = self.int_nan
-        for i in ints:
-            try:
-                data_list[i][j] = data[i]
-            except ValueError:
-                data_list[i][j] = self.int_nan
-        for i in strings:
-            data_list[i][j] = data[i]
+    def region_cached(self, region):
+        """ Checks if disk cache of region exists and was built from current zips.
 
-        return None
+        Without any zips in folder the disk cache is used as it is.
+        :param region: region code
+        :return: True if disk cache can be used
+        """
+        meta = self.region_meta(region)
+        if not meta:
+            return False
+        return not self.zip_files() or meta.get('sources') == self.sources()
 
-    def get_list(self, regions=None):
-        """ Concatenate formatted data for every given region, stores them into memory and cache(compressed on disk).
+    @instrument.traced(rows=lambda data: frame_rows(data[1]))
+    def get_list(self, regions=None, workers=None, columns=None, years=None, months=None):
+        """ Concatenate formatted data for every given region, stores them into memory and cache(columnar on disk).
 
         If regions are not specified it gets data of every region (region codes stored in instance attribute). Every
         regions data concatenates into numpy arrays representing columns. It takes data from memory if available, if not
         from disk cache if disk cache is not created it calls parser, formatted data stores into disk cache, memory.
+        Memory is LRU cache of columns limited by cache_bytes, it is filled from both disk cache and parser. Columns in
+        memory are keyed by build of year partition, so partition rebuilt by another instance is loaded again. Columns
+        from disk cache are memory-mapped, disk cache is used only if it was built from the same zips.
+        Regions which are not cached or whose zips changed are (incrementally) built before concatenation, with more
+        workers in process pool (see build_regions). Only requested columns are loaded and concatenated.
+        Disk cache is partitioned by years, partitions of not requested years are not touched at all and months are
+        contiguous ranges of rows inside year partition, so filtering by years and months does not read other rows.
+        Rows are ordered by region, year and month.
         :param regions: list of regions to create list of
-        :return:  tuple of list of column headers for data and list of numpy arrays where every array is one column
+        :param workers: number of processes used for parsing, regions are parsed sequentially if not set
+        :param columns: list of column headers (from COLUMNS or 'region') to get, all columns if not set
+        :param years: list of years to get, all years if not set
+        :param months: list of months (1-12) to get, all months if not set
+        :return:  tuple of list of column headers for data and list of columns (numpy arrays or EncodedColumn)
         """
-        full_data = []
-        full_header = []
+        data_header = ['region'] + COLUMNS
+        full_header = data_header if columns is None else list(columns)
+        unknown = [name for name in full_header if name not in data_header]
+        if unknown:
+            raise ValueError(f'unknown columns: {unknown}')
 
         if not regions:
             regions = self.region_codes.keys()
 
+        if not self.offline:
+            self.download_data()  # newly published zips are found even if regions are cached
+        missing = [reg for reg in regions if not self.region_cached(reg)]
+        if missing:
+            self.build_regions(missing, workers)
+
+        parts = []
         for reg in regions:
             print(f'Parsing... ({reg})')
-            # saved in memory
-            if reg in self.cache:
-                reg_data = self.cache.get(reg)
-            # saved in cache on disk
-            elif os.path.exists(f'{self.folder}/{self.cache_file.format(reg)}'):
-                with gzip.open(f'{self.folder}/{self.cache_file.format(reg)}', 'rb') as f:
-                    reg_data = pickle.load(f)
-            # unprocessed
-            else:
-                reg_data = self.parse_region_data(reg)  # parse data
-                with gzip.open(f'{self.folder}/{self.cache_file.format(reg)}', 'w+b') as f:  # save to cache on disk
-                    pickle.dump(reg_data, f)
-                self.cache[reg] = reg_data  # save to memory
-
-            # concatenate data from all regions
-            if not full_data:
-                full_data = reg_data[1].copy()
-                full_header = reg_data[0].copy()
-            else:
-                for i in range(len(reg_data[0])):
-                    full_data[i] = np.concatenate((full_data[i], reg_data[1][i]))
-
-        return full_header, full_data
+            path = self.cache_path(reg)
+            meta = self.region_meta(reg)
+            partitions = meta['partitions']
+
+            for year in sorted(int(year) for year in partitions):
+                if years is not None and year not in years:
+                    continue
+                ranges = [(start, stop) for month, start, stop in partitions[str(year)]
+                          if months is None or month in months]
+                if not ranges:
+                    continue
+
+                # saved in memory
+                key = self.partition_key(reg, year, meta)
+                year_data = {name: self.cache.get(key + (name,)) for name in full_header}
+                lacking = [name for name, column in year_data.items() if column is None]
+
+                # saved in cache on disk
+                if lacking:
+                    year_meta = store.read_meta(os.path.join(path, str(year)))
+                    indexes = [year_meta['header'].index(name) for name in lacking]
+                    for name, column in zip(*store.load_columns(os.path.join(path, str(year)), year_meta, indexes)):
+                        year_data[name] = column
+                        self.cache.put(key + (name,), column)
+
+                # adjacent months are one range of rows
+                merged = [list(ranges[0])]
+                for start, stop in ranges[1:]:
+                    if start == merged[-1][1]:
+                        merged[-1][1] = stop
+                    else:
+                        merged.append([start, stop])
+                for start, stop in merged:
+                    parts.append([year_data[name][start:stop] for name in full_header])
+
+        # concatenate data from all regions
+        if not parts:
+            return full_header, []
+        if len(parts) == 1:
+            return full_header, parts[0]
+        return full_header, [concat_parts(list(column)) for column in zip(*parts)]
+
+    @instrument.traced(rows=len)
+    def get_dataframe(self, regions=None, workers=None, columns=None, years=None, months=None):
+        """ Returns data of given regions as pandas DataFrame with columns named as in accidents.pkl.gz.
+
+        Columns already have final data types (categories, narrow integers, datetime64 date), numeric columns wrap
+        arrays from get_list without copying (see frame.to_dataframe).
+        :param regions: list of regions, all regions if not set
+        :param workers: number of processes used for parsing, regions are parsed sequentially if not set
+        :param columns: list of DataFrame columns (from frame.FRAME_COLUMNS), all columns if not set
+        :param years: list of years to get, all years if not set
+        :param months: list of months (1-12) to get, all months if not set
+        :return: pandas DataFrame
+        """
+        names = None if columns is None else list(columns)
+        sources = source_columns(names) if names is not None else None
+        header, data = self.get_list(regions, workers, sources, years, months)
+        if not data:
+            # no rows, empty columns with parsed data types
+            data = [np.empty(0, dtype='<U3' if name == 'region' else types[COLUMNS.index(name)]) for name in header]
+        with instrument.span('to_dataframe', rows=frame_rows(data)):
+            return to_dataframe(header, data, self.int_nan, names)
+
+    def id_index(self, region, year, meta=None):
+        """ Returns hash index of IDs of year partition, index is built once and kept until partition is rebuilt.
+
+        :param region: region code
+        :param year: year of partition
+        :param meta: already read metadata of region, read from disk if not given
+        :return: tuple of pandas Index of unique IDs and numpy array of their row positions in partition
+        """
+        key = self.partition_key(region, year, meta)
+        if key not in self.indexes:
+            ids = self.cache.get(key + ('ID',))
+            if ids is None:
+                path = os.path.join(self.cache_path(region), str(year))
+                meta = store.read_meta(path)
+                ids = store.load_columns(path, meta, [meta['header'].index('ID')])[1][0]
+            ids = np.asarray(ids)
+            positions = np.flatnonzero(ids != '')  # rows without ID are not indexed
+            self.indexes[key] = (pd.Index(ids[positions]), positions)
+        return self.indexes[key]
+
+    def lookup(self, ids, regions=None, years=None):
+        """ Finds rows of accidents with given IDs.
+
+        Position is the row number in data of region and year, as returned by get_list(regions=[region], years=[year]).
+        IDs are unique in every year partition (see build_region), so every ID is found at most once in a partition.
+        :param ids: list of IDs
+        :param regions: list of regions to search in, all regions if not set
+        :param years: list of years to search in, all years if not set
+        :return: tuple of numpy arrays of regions, years and row positions for every given ID, region is '', year and
+                 position are -1 for IDs which were not found
+        """
+        ids = np.asarray(ids, dtype=str)
+        if not regions:
+            regions = self.region_codes.keys()
+
+        if not self.offline:
+            self.download_data()  # newly published zips are found even if regions are cached
+        missing = [reg for reg in regions if not self.region_cached(reg)]
+        if missing:
+            self.build_regions(missing)
+
+        found_regions = np.full(ids.shape[0], '', dtype='<U3')
+        found_years = np.full(ids.shape[0], -1, dtype=np.int64)
+        found_positions = np.full(ids.shape[0], -1, dtype=np.int64)
+        for reg in regions:
+            meta = self.region_meta(reg)
+            for year in sorted(int(year) for year in meta['partitions']):
+                if years is not None and year not in years:
+                    continue
+                index, positions = self.id_index(reg, year, meta)
+                hits = index.get_indexer(ids)
+                found = np.flatnonzero(hits >= 0)
+                found_regions[found] = reg
+                found_years[found] = year
+                found_positions[found] = positions[hits[found]]
+        return found_regions, found_years, found_positions
+
+    def iter_batches(self, regions=None, batch_size=1 << 16, columns=None, years=None, months=None, cached=True):
+        """ Iterates over data of given regions in batches with fixed number of rows, so memory does not depend on size
+        of data.
+
+        With cached data are read from disk cache (built if needed) partition by partition, memory-mapped columns are
+        only sliced and neither they nor batches are stored in memory cache. Without cached csv files are streamed
+        directly from zips by chunks, disk cache is not used at all (years and months are then not supported), rows of
+        accidents overwritten by newer zips are skipped as in disk cache.
+        Only the last batch can be smaller than batch_size.
+        :param regions: list of regions, all regions if not set
+        :param batch_size: number of rows in batch
+        :param columns: list of column headers (from COLUMNS or 'region') to get, all columns if not set
+        :param years: list of years to get, all years if not set
+        :param months: list of months (1-12) to get, all months if not set
+        :param cached: read disk cache if True, stream csv files from zips otherwise
+        :return: generator of tuples of list of column headers and list of columns (numpy arrays or EncodedColumn)
+        """
+        data_header = ['region'] + COLUMNS
+        full_header = data_header if columns is None else list(columns)
+        unknown = [name for name in full_header if name not in data_header]
+        if unknown:
+            raise ValueError(f'unknown columns: {unknown}')
+        if batch_size < 1:
+            raise ValueError('batch_size has to be positive')
+        if not cached and (years is not None or months is not None):
+            raise ValueError('years and months are supported only with cached data')
+
+        if not regions:
+            regions = self.region_codes.keys()
+
+        pieces = self.cached_pieces(regions, full_header, years, months) if cached \
+            else self.zip_pieces(regions, full_header)
+        for batch in rebatch(pieces, batch_size):
+            yield full_header, batch
+
+    def cached_pieces(self, regions, header, years=None, months=None):
+        """ Generates row ranges of year partitions of disk cache, see iter_batches.
+
+        :return: generator of lists of memory-mapped columns
+        """
+        if not self.offline:
+            self.download_data()  # newly published zips are found even if regions are cached
+        missing = [reg for reg in regions if not self.region_cached(reg)]
+        if missing:
+            self.build_regions(missing)
+
+        for reg in regions:
+            path = self.cache_path(reg)
+            partitions = self.region_meta(reg)['partitions']
+            for year in sorted(int(year) for year in partitions):
+                if years is not None and year not in years:
+                    continue
+                ranges = [(start, stop) for month, start, stop in partitions[str(year)]
+                          if months is None or month in months]
+                if not ranges:
+                    continue
+                meta = store.read_meta(os.path.join(path, str(year)))
+                indexes = [meta['header'].index(name) for name in header]
+                year_data = store.load_columns(os.path.join(path, str(year)), meta, indexes)[1]
+                for start, stop in ranges:
+                    yield [column[start:stop] for column in year_data]
+
+    def zip_chunks(self, zip_file, region):
+        """ Streams parsed chunks of csv file of region from zip (see read_csv). """
+        with ZipFile(zip_file) as zf:
+            with zf.open(self.region_codes[region][1], "r") as csv_raw:
+                yield from read_csv(csv_raw, self.int_nan)
+
+    def zip_pieces(self, regions, header):
+        """ Generates chunks of csv files streamed from zips, see iter_batches.
+
+        Accidents from overlapping zips are kept only once, as in disk cache (see build_region), so zips of region are
+        streamed twice. The first pass keeps only 64-bit keys of IDs (see id_keys), years and ranks of zips (12 bytes
+        per row) to find which rows are kept, the second pass yields chunks without the other rows.
+        :return: generator of lists of numpy arrays
+        """
+        self.download_data()
+        zip_files = self.zip_files()
+        indexes = [COLUMNS.index(name) if name != 'region' else None for name in header]
+        id_index, year_index = COLUMNS.index('ID'), COLUMNS.index('rok')
+
+        for reg in regions:
+            ids, years, ranks = [], [], []
+            for rank, zip_file in enumerate(zip_files):
+                for chunk in self.zip_chunks(zip_file, reg):
+                    ids.append(id_keys(chunk[id_index]))
+                    years.append(chunk[year_index].astype(np.int16))
+                    ranks.append(np.full(chunk[id_index].shape[0], rank, dtype=np.int16))
+            if not ids:
+                continue
+
+            # row from the newest zip is kept for every ID in every year
+            ids, years, ranks = np.concatenate(ids), np.concatenate(years), np.concatenate(ranks)
+            kept = np.zeros(ids.shape[0], dtype=bool)
+            for year in np.unique(years):
+                rows = np.flatnonzero(years == year)
+                kept[rows[last_unique(ids[rows], ranks[rows], EMPTY_KEY)]] = True
+            del ids, years, ranks
+
+            offset = 0
+            for zip_file in zip_files:
+                for chunk in self.zip_chunks(zip_file, reg):
+                    rows = kept[offset:offset + chunk[0].shape[0]]
+                    offset += chunk[0].shape[0]
+                    if not rows.all():
+                        chunk = [column[rows] for column in chunk]
+                    yield [np.full(chunk[0].shape[0], reg, dtype='<U3') if i is None else chunk[i] for i in indexes]
 
 
 if __name__ == "__main__":
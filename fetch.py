@@ -0,0 +1,163 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Concurrent, resumable downloading of data files with conditional revalidation.
+"""
+
+import json
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+import requests
+
+import instrument
+
+MANIFEST = 'manifest.json'  # sidecar file with validators of downloaded files
+PART = '.part'  # suffix of files which are not downloaded completely yet
+
+
+class Fetcher:
+    """ Downloads files into folder with bounded thread pool.
+
+    Unfinished downloads are kept as '<name>.part' and resumed with HTTP Range request, finished files are revalidated
+    with ETag/If-Modified-Since stored in sidecar manifest so unchanged files are not downloaded again.
+    """
+
+    def __init__(self, folder, header=None, workers=4, chunk_size=1 << 16, timeout=60):
+        self.folder = folder
+        self.header = header or {}
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.manifest_path = os.path.join(folder, MANIFEST)
+        self.lock = threading.Lock()  # guards manifest, which is shared by all worker threads
+        self.local = threading.local()  # one session per thread, sessions should not be shared between threads
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        """ Loads manifest from disk, missing or corrupted manifest is treated as empty.
+
+        :return: dictionary with 'files' entry mapping file names to their validators
+        """
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest.setdefault('files', {})
+        return manifest
+
+    def save_manifest(self):
+        """ Atomically writes manifest to disk, so killed run never leaves half-written manifest. """
+        with self.lock:
+            tmp = self.manifest_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+
+    def session(self):
+        """ Returns requests session of current thread. """
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.session()
+        return self.local.session
+
+    @instrument.traced()
+    def fetch(self, urls):
+        """ Downloads or revalidates every url in thread pool.
+
+        :param urls: list of urls of files, file is stored under last part of url
+        :return: list of paths to downloaded files in the same order as urls
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            paths = list(pool.map(self.fetch_one, urls))
+
+        self.save_manifest()
+        return paths
+
+    @instrument.traced()
+    def fetch_one(self, url):
+        """ Downloads one file, resumes its partial download or revalidates already downloaded file.
+
+        :param url: url of file
+        :return: path to downloaded file
+        """
+        name = url.split('/')[-1]
+        path = os.path.join(self.folder, name)
+        part = path + PART
+
+        with self.lock:
+            entry = dict(self.manifest['files'].get(name, {}))
+
+        headers = dict(self.header)
+        offset = 0
+
+        if os.path.exists(part) and entry.get('url') == url and (entry.get('etag') or entry.get('last_modified')):
+            # resume only when we are able to check that file on server did not change in the meantime
+            offset = os.path.getsize(part)
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = entry.get('etag') or entry.get('last_modified')
+        elif os.path.exists(path):
+            if name not in self.manifest['files']:
+                # file from older version without manifest, it could be cut off by killed run
+                if not zipfile.is_zipfile(path):
+                    os.remove(path)
+                else:
+                    headers['If-Modified-Since'] = formatdate(os.path.getmtime(path), usegmt=True)
+            else:
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+
+        with self.session().get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304:
+                self.update_entry(name, url, r, os.path.getsize(path))
+                return path
+            if r.status_code == 416:
+                # range is not satisfiable, partial file is broken, start again
+                os.remove(part)
+                return self.fetch_one(url)
+            r.raise_for_status()
+
+            if r.status_code != 206:
+                offset = 0  # server ignored range or file changed, whole file is sent
+
+            # store validators before writing, so download killed in the middle could be resumed
+            self.update_entry(name, url, r, None)
+            self.save_manifest()
+
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+
+        os.replace(part, path)
+        self.update_entry(name, url, r, os.path.getsize(path))
+        return path
+
+    def update_entry(self, name, url, response, size):
+        """ Stores validators from response into manifest.
+
+        :param name: file name
+        :param url: url of file
+        :param response: server response
+        :param size: size of completely downloaded file, None if download is not finished yet
+        """
+        with self.lock:
+            entry = self.manifest['files'].setdefault(name, {})
+            entry['url'] = url
+            if response.headers.get('ETag'):
+                entry['etag'] = response.headers['ETag']
+            if response.headers.get('Last-Modified'):
+                entry['last_modified'] = response.headers['Last-Modified']
+            if size is not None:
+                entry['size'] = size
+            elif response.status_code != 206:
+                entry.pop('size', None)
@@ -0,0 +1,201 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Conversion of parsed columns into pandas DataFrame with final data types, numpy arrays are not copied.
+"""
+
+import numpy as np
+import pandas as pd
+
+from columns import EncodedColumn, compact
+
+# names of DataFrame columns (as in accidents.pkl.gz) for parsed columns, date and time are joined into p2a and p2b
+NAMES = {'ID': 'p1', 'druh pozemnej komunikacie': 'p36', 'cislo pozemnej komunikacie': 'p37',
+         'den v tyzdni': 'weekday(p2a)', 'druh nehody': 'p6', 'druh zrazky iducich vozidiel': 'p7',
+         'druh pevnej prekazky': 'p8', 'charakter nehody': 'p9', 'zavinenie nehody': 'p10',
+         'alkohol u vinnika nehody pritomny': 'p11', 'hlavne priciny nehody': 'p12', 'usmrtenych osob': 'p13a',
+         'tazko zranenych osob': 'p13b', 'lahko zranenych osob': 'p13c', 'celkova hmotna skoda': 'p14',
+         'druh povrchu vozovky': 'p15', 'stav povrchu vozovky v dobe nehody': 'p16', 'stav komunikacie': 'p17',
+         'poveternostne podmienky v dobe nehody': 'p18', 'viditelnost': 'p19', 'rozhladove pomery': 'p20',
+         'delenie komunikacie': 'p21', 'situovanie nehody na komunikacii': 'p22',
+         'riadenie premavky v dobe nehody': 'p23', 'miestna uprava prednosti v jazde': 'p24',
+         'specificke miesta a objekty v mieste nehody': 'p27', 'smerove pomery': 'p28',
+         'pocet zucastnenych vozidiel': 'p34', 'miesto dopravnej nehody': 'p35', 'druh krizujucej komunikacie': 'p39',
+         'druh vozidla': 'p44', 'vyrobna znacka motoroveho vozidla': 'p45a', 'rok vyroby vozidla': 'p47',
+         'charakteristika vozidla': 'p48a', 'smyk': 'p49', 'vozidlo po nehode': 'p50a',
+         'unik provoznych, prepravovanych hmot': 'p50b', 'zposob vyslobodenia osob z vozidla': 'p51',
+         'smer jazdy alebo postavenia vozidla': 'p52', 'skoda na vozidle': 'p53', 'kategoria sofera': 'p55a',
+         'stav sofera': 'p57', 'vonkajsie ovplyvnenie sofera': 'p58', 'a': 'a', 'b': 'b', 'gps_x': 'd', 'gps_y': 'e',
+         'f': 'f', 'g': 'g', 'h': 'h', 'i': 'i', 'j': 'j', 'k': 'k', 'l': 'l', 'n': 'n', 'o': 'o', 'p': 'p', 'q': 'q',
+         'r': 'r', 's': 's', 't': 't', 'lokalita nehody': 'p5a', 'region': 'region'}
+# integer time keys computed from date and hour, missing values are -1 (see time_keys)
+TIME_KEYS = ['year', 'yyyymm', 'isoweek', 'weekday', 'hour']
+# joined columns, DataFrame column -> parsed columns it is created from
+JOINED = {'p2a': ['rok', 'mesiac-den'], 'p2b': ['hodina', 'minuta'], 'hour': ['hodina'],
+          **{name: ['rok', 'mesiac-den'] for name in TIME_KEYS[:-1]}}
+# order of DataFrame columns
+FRAME_COLUMNS = ['p1', 'p36', 'p37', 'p2a', 'weekday(p2a)', 'p2b'] + \
+                [name for name in NAMES.values() if name not in ['p1', 'p36', 'p37', 'weekday(p2a)']] + TIME_KEYS
+
+to_category = ['region', 'a', 'b', 'h', 'i', 'j', 'k', 'l', 'n', 'o', 'p', 'q', 'r', 's', 't']
+to_float = ['d', 'e', 'f', 'g']
+to_int8 = ['p5a', 'p6', 'p7', 'p8', 'p9', 'p10', 'p11', 'p15', 'p16', 'p18', 'p19', 'p20', 'p21', 'p22', 'p23', 'p24',
+           'p27', 'p28', 'p49', 'p50a', 'p50b', 'p51', 'p55a', 'p57', 'p58']
+
+
+def source_columns(names):
+    """ Returns parsed columns needed for given DataFrame columns.
+
+    :param names: list of DataFrame columns (from FRAME_COLUMNS)
+    :return: list of parsed column headers (from COLUMNS or 'region')
+    """
+    unknown = [name for name in names if name not in FRAME_COLUMNS]
+    if unknown:
+        raise ValueError(f'unknown columns: {unknown}')
+
+    parsed = {name: column for column, name in NAMES.items()}
+    sources = []
+    for name in names:
+        for column in JOINED.get(name, [parsed.get(name)]):
+            if column not in sources:
+                sources.append(column)
+    return sources
+
+
+def dates(years, month_days, nan):
+    """ Joins years and 'MM-DD' strings into dates, only unique pairs are converted, invalid dates are NaT.
+
+    :param years: numpy array of years
+    :param month_days: numpy array of strings or EncodedColumn
+    :param nan: "my NaN number" of years
+    :return: numpy array of datetime64[ns]
+    """
+    if isinstance(month_days, EncodedColumn):
+        md_values, md_codes = month_days.dictionary, month_days.codes
+    else:
+        md_values, md_codes = np.unique(month_days, return_inverse=True)
+        md_codes = md_codes.reshape(-1)
+    year_values, year_codes = np.unique(years, return_inverse=True)
+
+    table = np.full((year_values.shape[0], md_values.shape[0]), np.datetime64('NaT'), dtype='datetime64[ns]')
+    for i, year in enumerate(year_values):
+        if year != nan:
+            table[i] = pd.to_datetime([f'{year:04d}-{md}' for md in md_values], format='%Y-%m-%d',
+                                      errors='coerce').to_numpy()
+    return table[year_codes.reshape(-1), md_codes]
+
+
+def time_keys(dates=None, hours=None):
+    """ Computes integer time keys of rows at once, so time buckets are grouped as integers and not as strings.
+
+    Keys are year, year and month as YYYYMM, ISO year and ISO week as YYYYWW, ISO weekday (1 is Monday) and hour.
+    :param dates: numpy array or pandas Series of dates (datetime64), NaT is missing date, keys of date are not
+                  computed if not set
+    :param hours: numpy array or pandas Series of hours, values out of 0-23 are missing hour, hour key is not
+                  computed if not set
+    :return: dictionary mapping names of keys (TIME_KEYS) to numpy arrays of integers, missing values are -1
+    """
+    keys = {}
+    if hours is not None:
+        hours = np.asarray(hours)
+        keys['hour'] = np.where((hours >= 0) & (hours < 24), hours, -1).astype(np.int8)
+    if dates is None:
+        return keys
+
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    missing = np.isnat(dates)
+    days = np.where(missing, 0, dates.astype(np.int64))
+
+    year = days.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970
+    month = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64) % 12 + 1
+    weekday = (days + 3) % 7 + 1  # 1.1.1970 was Thursday
+
+    # ISO week belongs to ISO year of its Thursday
+    thursday = days - weekday + 4
+    iso_year = thursday.astype('datetime64[D]').astype('datetime64[Y]')
+    week = (thursday - iso_year.astype('datetime64[D]').astype(np.int64)) // 7 + 1
+
+    date_keys = {'year': year.astype(np.int16), 'yyyymm': (year * 100 + month).astype(np.int32),
+                 'isoweek': ((iso_year.astype(np.int64) + 1970) * 100 + week).astype(np.int32),
+                 'weekday': weekday.astype(np.int8)}
+    for key in date_keys.values():
+        key[missing] = -1
+    keys.update(date_keys)
+    return keys
+
+
+def to_dataframe(header, columns, nan, names=None):
+    """ Creates DataFrame from parsed columns (see DataDownloader.get_list).
+
+    Columns are converted directly into final data types used by analysis, so no conversion pass is needed.
+    Dictionary-encoded columns become categories with the same codes, integers keep their narrowest type (int8 for
+    to_int8 columns as in converted pickle), date is created as datetime64 from year and month-day and time as HHMM
+    integer (2560 is unknown). Integer time keys (TIME_KEYS) are computed from date and hour.
+    Numeric columns are wrapped without copying, columns are copied only if they contain "my NaN number". It is
+    replaced by NaN in float columns, integer columns become nullable (Int8 for to_int8 columns) with missing values.
+    :param header: list of parsed column headers
+    :param columns: list of numpy arrays or EncodedColumn
+    :param nan: "my NaN number" used by parser
+    :param names: list of DataFrame columns (from FRAME_COLUMNS), all columns if not set
+    :return: pandas DataFrame
+    """
+    names = FRAME_COLUMNS if names is None else names
+    data = dict(zip(header, columns))
+    rows = columns[0].shape[0] if columns else 0
+
+    frame = {}
+    date, keys = None, None
+    for name in names:
+        if name == 'p2a' or name in TIME_KEYS[:-1]:
+            if date is None:
+                date = dates(np.asarray(data['rok']), data['mesiac-den'], nan) if rows \
+                    else np.empty(0, dtype='datetime64[ns]')
+            if name != 'p2a' and keys is None:
+                keys = time_keys(date)
+            frame[name] = date if name == 'p2a' else keys[name]
+            continue
+        if name == 'hour':
+            frame[name] = time_keys(hours=data['hodina'])[name]
+            continue
+        if name == 'p2b':
+            hours = np.where(data['hodina'] == nan, 25, data['hodina'])
+            minutes = np.where(data['minuta'] == nan, 60, data['minuta'])
+            frame[name] = (hours * 100 + minutes).astype(np.int16)
+            continue
+
+        column = data[source_columns([name])[0]]
+        if isinstance(column, EncodedColumn):
+            # pandas needs signed codes, codes are smaller than size of dictionary so they can be viewed as signed
+            codes = column.codes.view(column.codes.dtype.str.replace('u', 'i'))
+            if column.dictionary.shape[0] > np.iinfo(codes.dtype).max:
+                codes = column.codes.astype(np.int64)
+            frame[name] = pd.Categorical.from_codes(codes, categories=column.dictionary)
+            continue
+        if column.dtype.kind == 'f':
+            missing = column == nan
+            if missing.any():
+                column = np.where(missing, np.nan, column)
+        elif column.dtype.kind == 'i':
+            missing = column == nan
+            if missing.any():
+                # nullable integers, so dropna removes malformed values and sums do not include "my NaN number"
+                values = compact(np.where(missing, 0, column))
+                column = pd.arrays.IntegerArray(values.astype(np.int8) if name in to_int8 else values, missing)
+        if name in to_float:
+            column = column.astype(np.float64, copy=False)
+        elif name in to_category:
+            if isinstance(column, pd.arrays.IntegerArray):
+                # missing values are not categories, categories keep numpy type
+                column = pd.Categorical(column)
+                column = pd.Categorical.from_codes(column.codes, column.categories.to_numpy(
+                    column.categories.dtype.numpy_dtype))
+            else:
+                column = pd.Categorical(column)
+        elif name in to_int8 and isinstance(column, np.ndarray):
+            column = column.astype(np.int8, copy=False)
+        elif column.dtype.kind == 'U':
+            column = column.astype(object)
+        frame[name] = column
+
+    return pd.DataFrame(frame, copy=False)
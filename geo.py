@@ -11,11 +11,19 @@ Description: Script for creating graphs of car crash accidents in and outside ci
 import pandas as pd
 import geopandas
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm, Normalize
 import contextily as ctx
 import sklearn.cluster
 import numpy as np
 
+from download import COUNT, DataDownloader, GRID_CELLS, GRID_ORIGIN, cell_range
+import instrument
+import tiles
 
+ATTRIBUTION = ctx.providers.Stamen.TonerLite.get('attribution')  # tiles are from Stamen TonerLite (tiles.TILE_URL)
+
+
+@instrument.traced(rows=len)
 def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
     """ Konvertovani dataframe do geopandas.GeoDataFrame se spravnym kodovani"""
     # select region
@@ -29,68 +37,180 @@ def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
 
     return gdf
 
-def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False):
-    """ Vykresleni grafu s dvemi podgrafy podle lokality nehody """
+def rasterize(x, y, extent, shape):
+    """ Counts points in every pixel of grid at once (pixel indexes and one bincount).
+
+    :param x: numpy array of x coordinates
+    :param y: numpy array of y coordinates
+    :param extent: tuple of left, right, bottom and top of grid
+    :param shape: tuple of number of rows and columns of grid
+    :return: 2D numpy array of counts, the first row is at bottom
+    """
+    left, right, bottom, top = extent
+    rows, cols = shape
+    inside = (x >= left) & (x <= right) & (y >= bottom) & (y <= top)
+    col = ((x[inside] - left) / max(right - left, 1e-9) * cols).astype(np.int64)
+    row = ((y[inside] - bottom) / max(top - bottom, 1e-9) * rows).astype(np.int64)
+    pixels = np.minimum(row, rows - 1) * cols + np.minimum(col, cols - 1)  # points on right and top edge
+    return np.bincount(pixels, minlength=rows * cols).reshape(rows, cols)
+
+
+def plot_density(ax, gdf, extent=None, cmap='Reds', scale='log', vmax=None):
+    """ Draws points as one image of their density, pixel of image is pixel of axes.
+
+    Render time depends on size of axes in pixels, not on number of points. Empty pixels are transparent.
+    :param ax: matplotlib axes
+    :param gdf: geopandas.GeoDataFrame of points
+    :param extent: tuple of left, right, bottom and top of image, bounds of points if not set
+    :param cmap: matplotlib colormap
+    :param scale: 'log' or 'linear' colour scale
+    :param vmax: count with the darkest colour, the largest count if not set
+    """
+    with instrument.span('plot_density', rows=len(gdf)):
+        x, y = gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()
+        if extent is None:
+            minx, miny, maxx, maxy = gdf.total_bounds
+            extent = (minx, maxx, miny, maxy)
+        box = ax.get_window_extent()
+        shape = (max(int(box.height), 1), max(int(box.width), 1))
+
+        counts = np.ma.masked_equal(rasterize(x, y, extent, shape), 0)
+        vmax = vmax or max(int(counts.max() or 1), 1)
+        norm = LogNorm(vmin=1, vmax=max(vmax, 2)) if scale == 'log' else Normalize(vmin=0, vmax=vmax)
+        ax.imshow(counts, extent=extent, origin='lower', cmap=cmap, norm=norm, interpolation='nearest')
+
+
+@instrument.traced()
+def plot_grid(ax, bounds, downloader=None, regions=None, column=COUNT, cmap='Reds', scale='log', max_cells=GRID_CELLS):
+    """ Draws crashes in bounding box as one image of cells of precomputed grid pyramid (see DataDownloader.grid).
+
+    Raw points are not read, so every pan or zoom of map costs only cells visible in it. Axes are in EPSG:5514,
+    empty cells are transparent.
+    :param ax: matplotlib axes
+    :param bounds: tuple of minimal x, minimal y, maximal x and maximal y in EPSG:5514 ('d' and 'e' columns)
+    :param downloader: DataDownloader with disk cache, default one is created if not set
+    :param regions: list of region codes, all regions if not set
+    :param column: value of cell, COUNT or summed injuries (e.g. 'usmrtenych osob')
+    :param cmap: matplotlib colormap
+    :param scale: 'log' or 'linear' colour scale
+    :param max_cells: maximal number of cells in image, level of pyramid is chosen by it
+    :return: side of cell in metres
+    """
+    size, header, columns = (downloader or DataDownloader()).grid(bounds, regions, max_cells=max_cells)
+    data = dict(zip(header, columns))
+    c0, r0, c1, r1 = cell_range(bounds, size)
+    left, bottom = GRID_ORIGIN[0] + c0 * size, GRID_ORIGIN[1] + r0 * size
+
+    values = np.zeros((r1 - r0 + 1, c1 - c0 + 1), dtype=np.int64)
+    values[(data['gps_y'] - bottom) // size, (data['gps_x'] - left) // size] = data[column]
+    values = np.ma.masked_equal(values, 0)
+    vmax = max(int(values.max() or 1), 1)
+    norm = LogNorm(vmin=1, vmax=max(vmax, 2)) if scale == 'log' else Normalize(vmin=0, vmax=vmax)
+    ax.imshow(values, extent=(left, left + values.shape[1] * size, bottom, bottom + values.shape[0] * size),
+              origin='lower', cmap=cmap, norm=norm, interpolation='nearest')
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    return size
+
+
+@instrument.traced()
+def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False,
+             tile_store: tiles.TileStore = None, raster: bool = False, scale: str = 'log'):
+    """ Vykresleni grafu s dvemi podgrafy podle lokality nehody, podklad je z tile_store (nebo sdileneho uloziste)
+
+        With raster, points are drawn as density images (see plot_density) with given colour scale.
+        """
     
     # create subplots
     fig, axs = plt.subplots(1, 2, figsize=(20, 15), sharex=True, sharey=True) ###
     
     # plot accidents in city and outside city
-    gdf[gdf["p5a"] == 1].plot(ax=axs[0], markersize=1, color='red')
-    gdf[gdf["p5a"] == 2].plot(ax=axs[1], markersize=1, color='green')
-    fig.tight_layout()
-
-    # for each subplot
-    for i in range(2):
-        # set ticks
-        axs[i].set(xlabel=None, ylabel=None)
-        axs[i].tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
-        
-        # set basemap
-        ctx.add_basemap(axs[i], crs=gdf.crs.to_string(), source=ctx.providers.Stamen.TonerLite)
+    if raster:
+        fig.tight_layout()
+        minx, miny, maxx, maxy = gdf.total_bounds
+        plot_density(axs[0], gdf[gdf["p5a"] == 1], (minx, maxx, miny, maxy), cmap='Reds', scale=scale)
+        plot_density(axs[1], gdf[gdf["p5a"] == 2], (minx, maxx, miny, maxy), cmap='Greens', scale=scale)
+    else:
+        gdf[gdf["p5a"] == 1].plot(ax=axs[0], markersize=1, color='red')
+        gdf[gdf["p5a"] == 2].plot(ax=axs[1], markersize=1, color='green')
+        fig.tight_layout()
+
+    # for each subplot, basemap tiles are served from local tile store
+    with tiles.TileServer((tile_store or tiles.shared_store()).get) as source:
+        for i in range(2):
+            # set ticks
+            axs[i].set(xlabel=None, ylabel=None)
+            axs[i].tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
+
+            # set basemap
+            with instrument.span('basemap'):
+                ctx.add_basemap(axs[i], crs=gdf.crs.to_string(), source=source, attribution=ATTRIBUTION)
 
     # set titles
     axs[0].title.set_text('Nehody v JHM: v obci')
     axs[1].title.set_text('Nehody v JHM: mimo obci')
     
     if fig_location is not None:
-        plt.savefig(fig_location)
+        with instrument.span('savefig'):
+            plt.savefig(fig_location)
     if show_figure:
         plt.show()
 
 
-def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False):
-    """ Vykresleni grafu s lokalitou vsech nehod v kraji shlukovanych do clusteru """
-    # create figures
-    fig = plt.figure(figsize=(20, 8))
-    ax = plt.gca()
-    
+@instrument.traced()
+def cluster_crashes(gdf, n_clusters=15):
+    """ Groups accidents into clusters by their location (MiniBatchKMeans), number of accidents is counted in cluster.
+
+    :param gdf: geopandas.GeoDataFrame of accidents
+    :param n_clusters: number of clusters
+    :return: tuple of GeoDataFrame of accidents as points in EPSG:3857 and GeoDataFrame of clusters with number of
+             accidents in 'cnt' column and center of cluster as geometry
+    """
     gdf_c = gdf.to_crs("EPSG:5514") # correct system
     gdf_c = gdf_c.set_geometry(gdf_c.centroid).to_crs(epsg=3857)
-    
-    # plot all accidents
-    gdf_c.plot(ax=ax, color='grey', markersize=0.2)
-    
+
     # get coordinates
     coords = np.dstack([gdf_c.geometry.x, gdf_c.geometry.y]).reshape(-1, 2)
-    
+
     # create clusters
-    db = sklearn.cluster.MiniBatchKMeans(n_clusters=15).fit(coords)
+    db = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters).fit(coords)
 
     gdf4 = gdf_c.copy()
     gdf4["cluster"] = db.labels_
-    
+
     # group by clusters, number of accidents into 'cnt' column
     gdf4 = gdf4.dissolve(by="cluster", aggfunc={"p1": "count"}).rename(columns=dict(p1="cnt"))
 
     gdf_coords = geopandas.GeoDataFrame(geometry=geopandas.points_from_xy(db.cluster_centers_[:, 0], db.cluster_centers_[:, 1]))
-    gdf5 = gdf4.merge(gdf_coords, left_on="cluster", right_index=True).set_geometry("geometry_y")
+    return gdf_c, gdf4.merge(gdf_coords, left_on="cluster", right_index=True).set_geometry("geometry_y")
+
+
+@instrument.traced()
+def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_figure: bool = False,
+                 tile_store: tiles.TileStore = None, raster: bool = False, scale: str = 'log'):
+    """ Vykresleni grafu s lokalitou vsech nehod v kraji shlukovanych do clusteru, podklad je z tile_store
+
+        With raster, all accidents are drawn as density image (see plot_density) with given colour scale.
+        """
+    # create figures
+    fig = plt.figure(figsize=(20, 8))
+    ax = plt.gca()
+    
+    # clusters of accidents
+    gdf_c, gdf5 = cluster_crashes(gdf)
+
+    # plot all accidents
+    if raster:
+        plot_density(ax, gdf_c, cmap='Greys', scale=scale)
+    else:
+        gdf_c.plot(ax=ax, color='grey', markersize=0.2)
 
     # plot clusters and legend
     gdf5.plot(ax=ax, markersize=gdf5["cnt"]/1e1, legend=True, column="cnt", alpha=0.5, vmin=0, vmax=gdf5['cnt'].max(), legend_kwds={'label': 'Pocet nehod'})
     
     # add basemap
-    ctx.add_basemap(ax, crs="epsg:3857", source=ctx.providers.Stamen.TonerLite) ###
+    with instrument.span('basemap'), tiles.TileServer((tile_store or tiles.shared_store()).get) as source:
+        ctx.add_basemap(ax, crs="epsg:3857", source=source, attribution=ATTRIBUTION) ###
     
     # set ticks and title
     ax.set(xlabel=None, ylabel=None)
@@ -99,13 +219,14 @@ def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None, show_fig
     
     
     if fig_location is not None:
-        plt.savefig(fig_location)
+        with instrument.span('savefig'):
+            plt.savefig(fig_location)
     if show_figure:
         plt.show()
 
 
 if __name__ == "__main__":
-    gdf = make_geo(pd.read_pickle("accidents.pkl.gz"))
+    gdf = make_geo(DataDownloader().get_dataframe())
     plot_geo(gdf, "geo1.png", show_figure=True)
     plot_cluster(gdf, "geo2.png", True)
 
@@ -12,25 +12,33 @@ import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.ticker import MultipleLocator
 
-from download import DataDownloader
+from columns import count_matrix
+from download import COUNT, DataDownloader
+import instrument
 
 
+@instrument.traced()
 def plot_stat(data_source, fig_location=None, show_figure=False):
     """ Plots number of crashes in every year for every region.
 
-    :param data_source: tuple of formatted data, index 0 is list of column header, index 1 is list od numpy arrays
+    :param data_source: tuple of formatted data, index 0 is list of column header, index 1 is list od numpy arrays,
+                        rows are crashes or groups of crashes with COUNT column (see DataDownloader.cube)
     :param fig_location: path where created figure will be stored
     :param show_figure: boolean if figure should be displayed
     """
-    # make matrix from regions and years with shape=(crashes, 2)
-    data = np.vstack((data_source[1][0], data_source[1][4])).T
-
-    regions = np.unique(data[:, 0])  # get all regions presented in data
-    crashes = np.zeros_like(regions, dtype=int)
+    # count crashes of every region in every year at once, matrix with shape=(regions, years)
+    header = data_source[0]
+    weights = data_source[1][header.index(COUNT)] if COUNT in header else None  # already aggregated data (cube)
+    regions, years, counts = count_matrix(data_source[1][header.index('region')],
+                                          data_source[1][header.index('rok')], weights)
 
     # get interval boundaries for years
-    max_year = int(data[np.argmax(data[:, 1])][1])
-    min_year = int(data[np.argmin(data[:, 1])][1])
+    max_year = int(years.max())
+    min_year = int(years.min())
+
+    # years without crashes in interval have zero crashes
+    year_counts = np.zeros((regions.shape[0], max_year - min_year + 1), dtype=int)
+    year_counts[:, years - min_year] = counts
 
     # create figure and subplots
     fig, axs = plt.subplots(max_year - min_year+1, 1, sharex=True, sharey=True)
@@ -41,11 +49,8 @@ def plot_stat(data_source, fig_location=None, show_figure=False):
     fig.tight_layout()
     fig.subplots_adjust(top=0.89)  # adjust space between figure title and first subplot
 
-    # compute number of crashes for each year for each region
     for y in range(max_year - min_year + 1):
-        for i, reg in enumerate(regions):
-            year_data = data[data[:, 1] == str(min_year+y)]
-            crashes[i] = np.sum(year_data == reg)
+        crashes = year_counts[:, y]
 
         # get array of indexes of number of crashes in descending order
         Ind = np.argsort(crashes)
@@ -86,7 +91,8 @@ def plot_stat(data_source, fig_location=None, show_figure=False):
         path = '/'.join(path)
         if not os.path.exists(f'{path}'):
             os.makedirs(path)
-        plt.savefig(f'{path}/{file}', bbox_inches="tight")
+        with instrument.span('savefig'):
+            plt.savefig(f'{path}/{file}', bbox_inches="tight")
 
     if show_figure:
         plt.show()
@@ -98,5 +104,5 @@ if __name__ == '__main__':
     parser.add_argument('--show_figure', action='store_true', help='Set to show figure')
     args = parser.parse_args()
 
-    data_source = DataDownloader().get_list()
+    data_source = DataDownloader().cube(['region', 'rok'])
     plot_stat(data_source, fig_location=args.fig_location, show_figure=args.show_figure)
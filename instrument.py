@@ -0,0 +1,212 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Opt-in instrumentation of pipeline stages, nested timing spans with row counts and memory deltas.
+"""
+
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+ENV = 'IZV_TRACE'  # path of trace file, instrumentation is enabled at import when set
+ENV_MALLOC = 'IZV_TRACE_MALLOC'  # when set to 1, allocations of python (and numpy) are traced by tracemalloc
+ENV_FORMAT = 'IZV_TRACE_FORMAT'  # 'chrome' or 'jsonl', format of trace file
+ENV_OWNER = 'IZV_TRACE_OWNER'  # pid of process which created trace file, other processes only append to it
+
+state = {'path': None, 'chrome': False, 'tracemalloc': False}
+local = threading.local()  # stack of open spans of thread
+
+
+def rss():
+    """ Returns current resident set size in bytes (0 if it is not known). """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def peak_rss():
+    """ Returns peak resident set size of process in bytes.
+
+    VmHWM of process is used where it is known, ru_maxrss survives exec on linux, so it would include peak of parent.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024  # kilobytes
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on linux
+
+
+def reset_peak_rss():
+    """ Resets peak resident set size of process to current one (VmHWM), it is not possible on every system.
+
+    :return: True if peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def enable(path, chrome=None, malloc=False):
+    """ Enables instrumentation, every finished span is appended to trace file.
+
+    Trace file is JSON lines (one span per line) or Chrome trace (JSON array of complete events, opened by
+    chrome://tracing or Perfetto, closing bracket is optional). Processes started later inherit environment, so worker
+    processes append their spans into the same file.
+    :param path: path to trace file, it is truncated
+    :param chrome: write Chrome trace, set by extension of path if not set ('.json' is Chrome trace)
+    :param malloc: measure memory deltas also by tracemalloc, it slows down allocations
+    """
+    chrome = path.endswith('.json') if chrome is None else chrome
+    with open(path, 'w') as f:
+        f.write('[\n' if chrome else '')
+    os.environ[ENV] = path
+    os.environ[ENV_FORMAT] = 'chrome' if chrome else 'jsonl'
+    os.environ[ENV_MALLOC] = '1' if malloc else '0'
+    os.environ[ENV_OWNER] = str(os.getpid())
+    start(path, chrome, malloc)
+
+
+def start(path, chrome, malloc):
+    """ Starts writing spans of this process into existing trace file. """
+    state.update(path=path, chrome=chrome, tracemalloc=malloc)
+    if malloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """ Disables instrumentation, processes started later do not trace either. """
+    state['path'] = None
+    for name in [ENV, ENV_FORMAT, ENV_MALLOC, ENV_OWNER]:
+        os.environ.pop(name, None)
+
+
+def enabled():
+    """ Returns True if spans are recorded. """
+    return state['path'] is not None
+
+
+def write(event):
+    """ Appends one event to trace file, file is opened for every event so forked processes do not share buffer. """
+    with open(state['path'], 'a') as f:
+        f.write(json.dumps(event, default=str) + (',\n' if state['chrome'] else '\n'))
+
+
+class Span:
+    """ Timing span of one stage, spans opened inside of it are its children.
+
+    Span records duration, number of processed rows (set by caller), change of RSS, growth of peak RSS and with
+    tracemalloc also change of traced memory.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.parent = None
+        self.depth = 0
+
+    def set(self, **args):
+        """ Adds arguments of span (e.g. rows=...). """
+        self.args.update(args)
+        return self
+
+    def __enter__(self):
+        stack = local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+
+        self.rss = rss()
+        self.peak = peak_rss()
+        self.traced = tracemalloc.get_traced_memory()[0] if state['tracemalloc'] else 0
+        self.time = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        local.stack.pop()
+        if not enabled():
+            return False
+
+        memory = {'rss_delta': rss() - self.rss, 'peak_rss_growth': peak_rss() - self.peak}
+        if state['tracemalloc']:
+            memory['traced_delta'] = tracemalloc.get_traced_memory()[0] - self.traced
+        if exc_type is not None:
+            memory['error'] = exc_type.__name__
+
+        if state['chrome']:
+            write({'name': self.name, 'ph': 'X', 'ts': round(self.time * 1e6), 'dur': round(seconds * 1e6),
+                   'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {**self.args, **memory}})
+        else:
+            write({'name': self.name, 'parent': self.parent, 'depth': self.depth, 'start': self.time,
+                   'seconds': seconds, 'pid': os.getpid(), 'tid': threading.get_ident(), **self.args, **memory})
+        return False
+
+
+class NullSpan:
+    """ Span used when instrumentation is disabled, it records nothing. """
+
+    def set(self, **args):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **args):
+    """ Returns span of stage for with statement, it records nothing if instrumentation is disabled.
+
+    :param name: name of stage
+    :param args: arguments of span (e.g. rows, region), more can be added by Span.set
+    :return: Span or NullSpan
+    """
+    return Span(name, args) if enabled() else NULL_SPAN
+
+
+def traced(name=None, rows=None):
+    """ Decorator which wraps every call of function into span.
+
+    :param name: name of span, name of function if not set
+    :param rows: function returning number of rows of result of function, rows are not recorded if not set
+    :return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return function(*args, **kwargs)
+            with Span(name or function.__name__, {}) as current:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    current.set(rows=rows(result))
+                return result
+        return wrapper
+    return decorator
+
+
+# instrumentation enabled by environment, trace file is created only by the first process
+if os.environ.get(ENV):
+    if os.environ.get(ENV_OWNER):
+        start(os.environ[ENV], os.environ.get(ENV_FORMAT) == 'chrome', os.environ.get(ENV_MALLOC) == '1')
+    else:
+        enable(os.environ[ENV], os.environ[ENV_FORMAT] == 'chrome' if os.environ.get(ENV_FORMAT) else None,
+               os.environ.get(ENV_MALLOC) == '1')
@@ -0,0 +1,78 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: In-memory LRU cache limited by size of stored values in bytes.
+"""
+
+import sys
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Cache which evicts least recently used values when size of stored values exceeds budget.
+
+    Counts hits, misses and evictions. Value larger than the whole budget is not stored at all.
+    """
+
+    def __init__(self, max_bytes=None, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes  # budget in bytes, unlimited if None
+        self.sizeof = sizeof  # function returning size of value in bytes
+        self.items = OrderedDict()  # key -> (value, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """ Returns value stored under key and marks it as recently used.
+
+        :param key: key of value
+        :param default: returned if key is not in cache
+        :return: stored value or default
+        """
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key][0]
+
+    def put(self, key, value):
+        """ Stores value under key, least recently used values are evicted to fit into budget.
+
+        :param key: key of value
+        :param value: stored value
+        """
+        self.pop(key)
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self.items[key] = (value, size)
+        self.bytes += size
+        while self.max_bytes is not None and self.bytes > self.max_bytes:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def pop(self, key):
+        """ Removes value stored under key, if there is any. """
+        if key in self.items:
+            self.bytes -= self.items.pop(key)[1]
+
+    def clear(self):
+        """ Removes all values, counters are kept. """
+        self.items.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """ Returns dictionary with counters and current size of cache. """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'bytes': self.bytes,
+                'items': len(self.items), 'max_bytes': self.max_bytes}
@@ -0,0 +1,171 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Report runner, renders all figures in parallel and skips figures whose inputs did not change.
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')  # headless backend, figures are only saved
+import matplotlib.pyplot as plt
+
+import store
+from download import MONTH, DataDownloader
+
+STATE = 'report.json'  # fingerprints of rendered figures, stored in folder with figures
+# dimensions of cube groups used instead of rows by plot_conseq and plot_surface (see DataDownloader.cube_dataframe)
+CUBE_BY = ['region', 'rok', MONTH, 'stav povrchu vozovky v dobe nehody']
+
+# figures of report, file name -> (module, plotting function, input data, keyword arguments)
+FIGURES = {
+    'crashes.png': ('get_stat', 'plot_stat', 'stat', {}),
+    '01_nasledky.png': ('analysis', 'plot_conseq', 'cube', {}),
+    '02_priciny.png': ('analysis', 'plot_damage', 'frame', {}),
+    '03_stav.png': ('analysis', 'plot_surface', 'cube', {}),
+    'geo1.png': ('geo', 'plot_geo', 'geo', {}),
+    'geo2.png': ('geo', 'plot_cluster', 'geo', {}),
+    'priciny_nehod.png': ('doc', 'accidents_cause', 'doc', {'region': 'JHM'}),
+    'nasledky_vs_priciny.png': ('doc', 'severity_wrt_cause', 'doc', {'region': 'JHM'}),
+}
+
+inputs = {}  # input data of worker process, input name -> data
+
+
+def init_worker(stat, cube, frame):
+    """ Stores data loaded by parent process into worker process, with fork they are not even copied. """
+    matplotlib.use('Agg')
+    inputs['stat'] = stat
+    inputs['cube'] = cube
+    inputs['frame'] = frame
+
+
+def worker_input(source):
+    """ Returns input data of figure, data derived from DataFrame are created once per worker.
+
+    :param source: name of input data ('stat', 'cube', 'frame', 'geo' or 'doc')
+    :return: input data
+    """
+    if source not in inputs:
+        if source == 'geo':
+            inputs[source] = importlib.import_module('geo').make_geo(inputs['frame'])
+        elif source == 'doc':
+            inputs[source] = importlib.import_module('doc').clean_data(inputs['frame'])
+    return inputs[source]
+
+
+def render(name, folder):
+    """ Renders one figure of report in worker process.
+
+    :param name: file name of figure (key of FIGURES)
+    :param folder: directory where figure is saved
+    """
+    module, function, source, kwargs = FIGURES[name]
+    plot = getattr(importlib.import_module(module), function)
+    data = worker_input(source)
+    path = os.path.join(folder, name)
+
+    if function == 'severity_wrt_cause':
+        # needs number of accidents computed by accidents_cause
+        accidents = importlib.import_module(module).accidents_cause(data, **kwargs)
+        plt.close('all')
+        plot(data, accidents, save_fig=path, **kwargs)
+    elif module == 'doc':
+        plot(data, save_fig=path, **kwargs)
+    else:
+        plot(data, fig_location=path, **kwargs)
+    plt.close('all')
+
+
+def fingerprint(sources, name):
+    """ Returns fingerprint of figure from content hashes of input zips and parameters of figure.
+
+    :param sources: dictionary mapping zip names to their content hashes
+    :param name: file name of figure (key of FIGURES)
+    :return: hex digest
+    """
+    key = json.dumps({'sources': sources, 'figure': [name, *FIGURES[name]]}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def run_report(folder='figures', workers=None, force=False, names=None, downloader=None):
+    """ Renders figures of report in process pool, figures whose data and parameters did not change are skipped.
+
+    Data are loaded only once in this process (and only if some figure has to be rendered) and shared with workers.
+    Figure which fails does not stop the others, it is rendered again in the next run.
+    :param folder: directory where figures are saved
+    :param workers: number of worker processes, number of CPUs if not set
+    :param force: render all figures even if they did not change
+    :param names: list of figures (keys of FIGURES) to render, all figures if not set
+    :param downloader: DataDownloader providing data, default one is created if not set
+    :return: dictionary mapping figure names to 'rendered', 'skipped' or error message
+    """
+    names = list(FIGURES) if names is None else list(names)
+    unknown = [name for name in names if name not in FIGURES]
+    if unknown:
+        raise ValueError(f'unknown figures: {unknown}')
+
+    downloader = downloader or DataDownloader()
+    downloader.download_data()
+    sources = downloader.sources()
+
+    os.makedirs(folder, exist_ok=True)
+    state_path = os.path.join(folder, STATE)
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+
+    result = {}
+    todo = []
+    for name in names:
+        if not force and state.get(name) == fingerprint(sources, name) and os.path.exists(os.path.join(folder, name)):
+            result[name] = 'skipped'
+        else:
+            todo.append(name)
+    if not todo:
+        return result
+
+    # load data once, only those which are needed
+    needed = {FIGURES[name][2] for name in todo}
+    stat = downloader.cube(['region', 'rok']) if 'stat' in needed else None
+    cube = downloader.cube_dataframe(CUBE_BY) if 'cube' in needed else None
+    frame = None
+    if needed - {'stat', 'cube'}:
+        frame = downloader.get_dataframe()
+        frame.insert(0, column='date', value=frame['p2a'])
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(stat, cube, frame)) as pool:
+        futures = {name: pool.submit(render, name, folder) for name in todo}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                result[name] = f'{type(error).__name__}: {error}'
+                state.pop(name, None)
+            else:
+                result[name] = 'rendered'
+                state[name] = fingerprint(sources, name)
+
+    store.write_json(state_path, state)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', default='figures', help='Set directory where figures are stored')
+    parser.add_argument('--workers', type=int, default=None, help='Set number of worker processes')
+    parser.add_argument('--force', action='store_true', help='Set to render also unchanged figures')
+    parser.add_argument('figures', nargs='*', help='Figures to render, all figures if not set')
+    args = parser.parse_args()
+
+    report = run_report(args.folder, args.workers, args.force, args.figures or None)
+    for figure, status in report.items():
+        print(f'{figure}: {status}')
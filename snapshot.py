@@ -0,0 +1,111 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Snapshot of converted DataFrame stored next to its source file, columns are loaded memory-mapped.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import store
+from columns import EncodedColumn
+import instrument
+
+SUFFIX = '.snapshot'  # snapshot of 'accidents.pkl.gz' is directory 'accidents.pkl.gz.snapshot'
+
+
+def snapshot_path(filename):
+    """ Returns directory with snapshot of source file. """
+    return filename + SUFFIX
+
+
+def source_key(filename, meta=None):
+    """ Returns key of source file, hash is computed only if size or modification time differs from meta.
+
+    :param filename: path to source file
+    :param meta: metadata of snapshot with key of source it was created from
+    :return: dictionary with size, modification time and sha1 of source file
+    """
+    stat = os.stat(filename)
+    old = (meta or {}).get('source', {})
+    if old.get('size') == stat.st_size and old.get('mtime') == stat.st_mtime:
+        return old
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': store.file_hash(filename)}
+
+
+@instrument.traced()
+def save_snapshot(filename, df):
+    """ Stores converted DataFrame as columnar snapshot of source file.
+
+    Categories and strings are stored as codes and dictionary, other columns as they are.
+    :param filename: path to source file
+    :param df: converted pandas DataFrame
+    """
+    header, columns, objects, ordered = [], [], {}, []
+    for i, name in enumerate(df.columns):
+        column = df[name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories = column.cat.categories.to_numpy()
+            if categories.dtype.kind not in 'biufcmM':
+                categories = categories.astype(str)
+            columns.append(EncodedColumn(column.cat.codes.to_numpy(), categories))
+            if column.cat.ordered:
+                ordered.append(i)
+        elif column.dtype.kind in 'biufcmM':
+            columns.append(column.to_numpy())
+        else:
+            # strings (or other objects) are dictionary-encoded, missing values have code -1
+            codes, uniques = pd.factorize(column.to_numpy(dtype=object))
+            columns.append(EncodedColumn(codes, np.asarray(uniques, dtype=object).astype(str)))
+            objects[str(i)] = str(column.dtype)  # object or str
+        header.append(name)
+
+    store.save_columns(snapshot_path(filename), header, columns,
+                       {'source': source_key(filename), 'objects': objects, 'ordered': ordered})
+
+
+@instrument.traced(rows=lambda df: 0 if df is None else len(df))
+def load_snapshot(filename, columns=None):
+    """ Loads DataFrame from snapshot of source file, if snapshot was created from the same source file.
+
+    Numeric columns and codes of categories are memory-mapped, only string columns are copied.
+    :param filename: path to source file
+    :param columns: list of columns to load, all columns if not set
+    :return: pandas DataFrame, None if there is no valid snapshot
+    """
+    path = snapshot_path(filename)
+    meta = store.read_meta(path)
+    if meta is None or not os.path.exists(filename):
+        return None
+
+    key = source_key(filename, meta)
+    if key.get('sha1') != meta['source'].get('sha1'):
+        return None
+    if key != meta['source']:
+        # source was only touched, snapshot is still valid
+        meta['source'] = key
+        store.write_json(os.path.join(path, store.META), meta)
+
+    names = meta['header'] if columns is None else list(columns)
+    unknown = [name for name in names if name not in meta['header']]
+    if unknown:
+        raise ValueError(f'unknown columns: {unknown}')
+
+    indexes = [meta['header'].index(name) for name in names]
+    data = {}
+    for i, name, column in zip(indexes, *store.load_columns(path, meta, indexes)):
+        if str(i) in meta['objects']:
+            values = column.dictionary.astype(object)[column.codes]
+            values[column.codes < 0] = np.nan
+            data[name] = pd.Series(values, dtype=meta['objects'][str(i)])
+        elif isinstance(column, EncodedColumn):
+            data[name] = pd.Categorical.from_codes(np.asarray(column.codes), categories=column.dictionary,
+                                                   ordered=i in meta['ordered'], validate=False)
+        else:
+            data[name] = np.asarray(column)  # plain ndarray view of memory-mapped file
+    if not meta['rows']:
+        return pd.DataFrame({name: [] for name in names})
+    return pd.DataFrame(data, copy=False)
@@ -0,0 +1,141 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Columnar on-disk cache, every column is stored in its own .npy file and loaded memory-mapped.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from columns import EncodedColumn
+
+META = 'meta.json'  # metadata of stored columns
+HASHES = 'hashes.json'  # memo of content hashes of source files
+
+
+def column_file(i, part=''):
+    """ Returns name of file with i-th column (or its part, dictionary of encoded column is stored separately). """
+    return f'col{i:02d}{part}.npy'
+
+
+def write_json(path, data):
+    """ Atomically writes data as json file. """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def read_meta(path):
+    """ Reads metadata of stored columns.
+
+    :param path: directory with stored columns
+    :return: dictionary with metadata, None if columns are not stored (or were not stored completely)
+    """
+    try:
+        with open(os.path.join(path, META), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_columns(path, header, columns, meta=None):
+    """ Stores every column into its own .npy file, metadata are written last so half-written cache is never used.
+
+    Columns are written into temporary directory which replaces old directory at the end.
+    :param path: directory where columns are stored
+    :param header: list of column headers
+    :param columns: list of numpy arrays or EncodedColumn (codes and dictionary are stored in separate files)
+    :param meta: additional metadata stored with columns
+    """
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    encoded = []
+    for i, column in enumerate(columns):
+        if isinstance(column, EncodedColumn):
+            np.save(os.path.join(tmp, column_file(i)), column.codes)
+            np.save(os.path.join(tmp, column_file(i, '.dict')), column.dictionary)
+            encoded.append(i)
+        else:
+            np.save(os.path.join(tmp, column_file(i)), column)
+
+    meta = dict(meta or {})
+    meta['encoded'] = encoded
+    meta['header'] = list(header)
+    meta['rows'] = int(columns[0].shape[0]) if columns else 0
+    write_json(os.path.join(tmp, META), meta)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def load_columns(path, meta=None, indexes=None):
+    """ Loads stored columns memory-mapped, so only pages which are really used are read from disk.
+
+    :param path: directory with stored columns
+    :param meta: already read metadata, read from disk if not given
+    :param indexes: indexes of columns to load, all columns are loaded if not given
+    :return: tuple of list of column headers and list of read-only memory-mapped numpy arrays (or EncodedColumn
+             with memory-mapped codes)
+    """
+    meta = meta or read_meta(path)
+    if indexes is None:
+        indexes = range(len(meta['header']))
+
+    columns = []
+    if meta['rows']:
+        for i in indexes:
+            column = np.load(os.path.join(path, column_file(i)), mmap_mode='r')
+            if i in meta.get('encoded', []):
+                column = EncodedColumn(column, np.load(os.path.join(path, column_file(i, '.dict'))))
+            columns.append(column)
+    return [meta['header'][i] for i in indexes], columns
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """ Computes sha1 of file content. """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_hashes(paths, folder):
+    """ Computes content hashes of source files.
+
+    Hashes are memoized in folder by size and modification time of file, so unchanged files are not read again.
+    :param paths: list of paths to files
+    :param folder: directory where memo of hashes is stored
+    :return: dictionary mapping file names to their content hashes
+    """
+    memo_path = os.path.join(folder, HASHES)
+    try:
+        with open(memo_path, 'r') as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        memo = {}
+
+    hashes = {}
+    changed = False
+    for path in paths:
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = memo.get(name)
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = memo[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': file_hash(path)}
+            changed = True
+        hashes[name] = entry['sha1']
+
+    if changed:
+        write_json(memo_path, memo)
+    return hashes
@@ -0,0 +1,222 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Generator of synthetic yearly zips with car crashes data in the same format as zips on server.
+"""
+
+import argparse
+import os
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import numpy as np
+
+from download import COLUMNS, types
+
+CHUNK_ROWS = 1 << 17  # rows generated and written at once
+
+# share of crashes in every region (approximately as in real data), key is region code of csv file
+REGION_WEIGHTS = {'00': 0.17, '01': 0.13, '02': 0.06, '03': 0.05, '04': 0.06, '05': 0.05, '06': 0.10, '07': 0.11,
+                  '14': 0.05, '15': 0.05, '16': 0.04, '17': 0.05, '18': 0.04, '19': 0.04}
+
+# ranges (low, high exclusive) of code columns, other integer columns have codes 0-9
+CODES = {'druh pozemnej komunikacie': (0, 9), 'cislo pozemnej komunikacie': (1, 3000), 'druh nehody': (0, 10),
+         'druh zrazky iducich vozidiel': (0, 5), 'zavinenie nehody': (0, 8), 'druh povrchu vozovky': (0, 7),
+         'pocet zucastnenych vozidiel': (1, 5), 'druh vozidla': (0, 19), 'vyrobna znacka motoroveho vozidla': (1, 100),
+         'rok vyroby vozidla': (0, 100), 'charakteristika vozidla': (0, 19), 'kategoria sofera': (0, 10),
+         'lokalita nehody': (1, 3), 'j': (0, 100000), 'o': (0, 10000), 'r': (0, 1000000), 's': (0, 1000000),
+         't': (0, 100)}
+# codes of main causes of crash (hlavne priciny nehody)
+CAUSES = np.array([100] + list(range(201, 210)) + list(range(301, 312)) + list(range(401, 415)) +
+                  list(range(501, 517)) + list(range(601, 616)))
+# mean number of persons, counts are drawn from poisson distribution
+INJURIES = {'usmrtenych osob': 0.01, 'tazko zranenych osob': 0.05, 'lahko zranenych osob': 0.3}
+# mean of values drawn from exponential distribution
+AMOUNTS = {'celkova hmotna skoda': 300, 'skoda na vozidle': 200}
+# values of string columns
+WORDS = ['', '', '', 'Pražská', 'Brněnská', 'Husova', 'Náměstí Míru', 'Žižkova', 'Štefánikova', 'Újezd',
+         'GN_V0.1UIR-ADR_410', 'D1', 'Křižovatka', 'Obec', 'Dálnice']
+# malformed values which are replaced by "my NaN number" when parsed
+BAD_INTS = ['', 'XX']
+BAD_FLOATS = ['', 'A:', '1,2,3']
+
+# bounding box of S-JTSK coordinates (gps_x is -Y, gps_y is -X) of Czech republic
+X_RANGE = (-900000, -430000)
+Y_RANGE = (-1230000, -935000)
+
+
+def as_bytes(values):
+    """ Returns numpy array of ISO-8859-2 byte strings of given values. """
+    return np.array([str(value).encode('ISO-8859-2') for value in values])
+
+
+def digits(numbers):
+    """ Converts non-negative integers into byte strings, width of strings is given by the longest number. """
+    return numbers.astype(f'S{len(str(int(numbers.max(initial=0))))}')
+
+
+def padded(numbers, width):
+    """ Converts non-negative integers into byte strings padded with zeros to given width. """
+    digits = (np.asarray(numbers) % 10 ** width + 10 ** width).astype(f'S{width + 1}')  # leading 1 keeps zeros
+    return np.ascontiguousarray(digits.view(np.uint8).reshape(-1, width + 1)[:, 1:]).view(f'S{width}').reshape(-1)
+
+
+def decimal(values):
+    """ Formats floats with 2 decimal places and decimal comma, as in csv files on server.
+
+    :param values: numpy array of floats
+    :return: list of pieces of field (numpy arrays of byte strings)
+    """
+    cents = np.round(np.abs(values) * 100).astype(np.int64)
+    return [np.where(values < 0, b'-', b''), digits(cents // 100), np.full(cents.shape, b','),
+            padded(cents % 100, 2)]
+
+
+def spoil(rng, pieces, rate, bad):
+    """ Replaces random fields by malformed values.
+
+    :param rng: numpy random Generator
+    :param pieces: list of pieces of field (numpy arrays of byte strings)
+    :param rate: probability of malformed value
+    :param bad: list of malformed values
+    :return: list of pieces of field
+    """
+    rows = pieces[0].shape[0]
+    broken = rng.random(rows) < rate
+    if not broken.any():
+        return pieces
+    values = as_bytes(bad)[rng.integers(0, len(bad), rows)]
+    return [np.where(broken, values, pieces[0])] + [np.where(broken, b'', piece) for piece in pieces[1:]]
+
+
+def generate(rng, rows, year, code, first_id, malformed=0.002):
+    """ Generates fields of rows of csv file, field is list of pieces which are joined in csv file.
+
+    :param rng: numpy random Generator
+    :param rows: number of rows
+    :param year: year of crashes
+    :param code: region code of csv file
+    :param first_id: sequence number of the first crash, IDs are unique in zip
+    :param malformed: probability of malformed value in integer and float column
+    :return: list of fields in order of columns in csv file
+    """
+    days = rng.integers(0, 365 + (year % 4 == 0), rows) + np.datetime64(f'{year}-01-01', 'D').astype(np.int64)
+    times = rng.integers(0, 24, rows) * 100 + rng.integers(0, 60, rows)
+    unknown = rng.random(rows)
+    times = np.where(unknown < 0.02, 2560, np.where(unknown < 0.03, 2500 + times % 100, times))  # unknown time
+
+    # region has its own part of bounding box
+    index = list(REGION_WEIGHTS).index(code)
+    x0 = X_RANGE[0] + (X_RANGE[1] - X_RANGE[0]) * (index % 7) / 7
+    y0 = Y_RANGE[0] + (Y_RANGE[1] - Y_RANGE[0]) * (index // 7) / 2
+
+    fields = []
+    for i, name in enumerate(COLUMNS):
+        if name == 'ID':
+            fields.append([as_bytes([code + f'{year % 100:02d}']), padded(first_id + np.arange(rows), 8)])
+        elif name == 'rok':
+            fields.append([days.astype('datetime64[D]').astype('S10')])
+        elif name == 'den v tyzdni':
+            fields.append([digits((days + 4) % 7)])  # 0 is Sunday, 1.1.1970 was Thursday
+        elif name == 'hodina':
+            fields.append([padded(times, 4)])
+        elif name in ['mesiac-den', 'minuta']:
+            continue  # date and time are one column in csv file
+        elif name == 'hlavne priciny nehody':
+            fields.append([digits(CAUSES[rng.integers(0, CAUSES.shape[0], rows)])])
+        elif name in INJURIES:
+            fields.append([digits(rng.poisson(INJURIES[name], rows))])
+        elif name in AMOUNTS:
+            fields.append(spoil(rng, [digits(rng.exponential(AMOUNTS[name], rows).astype(np.int64))],
+                                malformed, BAD_INTS))
+        elif name in ['gps_x', 'gps_y']:
+            low, size = (x0, (X_RANGE[1] - X_RANGE[0]) / 7) if name == 'gps_x' else (y0, (Y_RANGE[1] - Y_RANGE[0]) / 2)
+            fields.append(spoil(rng, decimal(low + rng.random(rows) * size), malformed * 5, BAD_FLOATS))
+        elif types[i] is float:
+            # other coordinates are mostly missing
+            fields.append(spoil(rng, decimal(rng.normal(0, 1000, rows)), 0.8, BAD_FLOATS))
+        elif types[i] is int:
+            low, high = CODES.get(name, (0, 10))
+            fields.append(spoil(rng, [digits(rng.integers(low, high, rows))], malformed, BAD_INTS))
+        else:
+            fields.append([as_bytes(WORDS)[rng.integers(0, len(WORDS), rows)]])
+    return fields
+
+
+def pack(fields):
+    """ Joins fields into lines of csv file, every field is quoted and fields are delimited by ';'.
+
+    Pieces of all fields are placed side by side as matrix of bytes, padding zeros are dropped at once.
+    :param fields: list of fields, field is list of numpy arrays of byte strings
+    :return: bytes of csv file
+    """
+    rows = max(piece.shape[0] for field in fields for piece in field)  # constant pieces have one value
+    quote = np.full((rows, 1), ord('"'), dtype=np.uint8)
+    delimiter = np.full((rows, 1), ord(';'), dtype=np.uint8)
+    newline = np.full((rows, 2), [ord('\r'), ord('\n')], dtype=np.uint8)
+    parts = []
+    for i, field in enumerate(fields):
+        parts.append(quote)
+        for piece in field:
+            piece = np.ascontiguousarray(np.broadcast_to(piece, (rows,)))
+            parts.append(piece.view(np.uint8).reshape(rows, piece.dtype.itemsize))
+        parts.append(quote)
+        parts.append(delimiter if i < len(fields) - 1 else newline)
+    matrix = np.concatenate(parts, axis=1)
+    return matrix[matrix != 0].tobytes()
+
+
+def write_zip(path, year, rows, seed=0, malformed=0.002, chunk_rows=CHUNK_ROWS):
+    """ Writes synthetic zip with crashes of one year, rows are split into csv file of every region.
+
+    :param path: path to zip file (e.g. 'data/datagis-rok-2020.zip')
+    :param year: year of crashes
+    :param rows: number of crashes in all regions
+    :param seed: seed of random generator, the same seed creates the same zip
+    :param malformed: probability of malformed value in integer and float column
+    :param chunk_rows: number of rows generated at once, limits used memory
+    """
+    codes = list(REGION_WEIGHTS)
+    weights = np.array(list(REGION_WEIGHTS.values()))
+    counts = np.random.default_rng([seed, year]).multinomial(rows, weights / weights.sum())
+
+    with ZipFile(path, 'w', ZIP_DEFLATED, compresslevel=1) as zf:
+        for index, (code, count) in enumerate(zip(codes, counts)):
+            rng = np.random.default_rng([seed, year, index])
+            with zf.open(f'{code}.csv', 'w', force_zip64=True) as csv_file:
+                for start in range(0, count, chunk_rows):
+                    chunk = min(chunk_rows, count - start)
+                    csv_file.write(pack(generate(rng, chunk, year, code, start, malformed)))
+
+
+def write_archive(folder, rows, years=(2016, 2017, 2018, 2019, 2020), seed=0, malformed=0.002):
+    """ Writes synthetic zips 'datagis-rok-YYYY.zip' of given years into folder.
+
+    :param folder: directory of zips, it is created if it does not exist
+    :param rows: number of crashes in all zips, rows are split evenly into years
+    :param years: list of years
+    :param seed: seed of random generator, the same seed creates the same zips
+    :param malformed: probability of malformed value in integer and float column
+    :return: list of paths to created zips
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i, year in enumerate(years):
+        path = os.path.join(folder, f'datagis-rok-{year}.zip')
+        write_zip(path, year, rows // len(years) + (i < rows % len(years)), seed, malformed)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder', help='Directory where zips are stored')
+    parser.add_argument('--rows', type=int, default=100000, help='Set number of crashes in all zips')
+    parser.add_argument('--years', type=int, nargs='+', default=[2016, 2017, 2018, 2019, 2020],
+                        help='Set years of zips')
+    parser.add_argument('--seed', type=int, default=0, help='Set seed of random generator')
+    parser.add_argument('--malformed', type=float, default=0.002, help='Set probability of malformed value')
+    args = parser.parse_args()
+
+    for zip_path in write_archive(args.folder, args.rows, args.years, args.seed, args.malformed):
+        print(zip_path)
@@ -0,0 +1,56 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Tests of memoized aggregations (results keyed by values of used columns).
+"""
+
+import numpy as np
+import pandas as pd
+
+from aggregate import Aggregator, fingerprint
+
+
+def crashes():
+    return pd.DataFrame({'region': pd.Categorical(['JHM', 'PHA', 'JHM']),
+                         'p13a': np.array([1, 2, 3], dtype=np.int8),
+                         'p12': pd.array([100, None, 300], dtype='Int16'),
+                         'p2a': ['a', 'b', 'c']})
+
+
+def sums(result):
+    return dict(zip(result['region'], result['s']))
+
+
+def test_repeated_aggregation_is_cached():
+    aggregator = Aggregator()
+    df = crashes()
+    first = aggregator.aggregate(df, ['region'], s=('p13a', 'sum'))
+    first['s'] = 0  # result is a copy
+    assert sums(aggregator.aggregate(df.copy(), ['region'], s=('p13a', 'sum'))) == {'JHM': 4, 'PHA': 2}
+    assert aggregator.cache.hits == 1
+
+
+def test_frame_modified_in_place():
+    aggregator = Aggregator()
+    df = crashes()
+    aggregator.aggregate(df, ['region'], s=('p13a', 'sum'))
+
+    df['p13a'] = [10, 20, 30]
+    assert sums(aggregator.aggregate(df, ['region'], s=('p13a', 'sum'))) == {'JHM': 40, 'PHA': 20}
+    df.loc[0, 'p13a'] = 0
+    assert sums(aggregator.aggregate(df, ['region'], s=('p13a', 'sum'))) == {'JHM': 30, 'PHA': 20}
+    df.loc[1, 'region'] = 'JHM'
+    assert sums(aggregator.aggregate(df, ['region'], s=('p13a', 'sum'))) == {'JHM': 50}
+    assert aggregator.cache.hits == 0
+
+
+def test_fingerprint_of_values():
+    df = crashes()
+    columns = ['region', 'p13a', 'p12', 'p2a']
+    assert fingerprint(df, columns) == fingerprint(crashes(), columns)
+    for name, value in [('p12', 100), ('p2a', 'x'), ('region', 'PHA')]:
+        changed = crashes()
+        changed.loc[2, name] = value
+        assert fingerprint(changed, columns) != fingerprint(df, columns)
+    assert fingerprint(df.astype({'p13a': np.int16}), columns) != fingerprint(df, columns)
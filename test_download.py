@@ -0,0 +1,184 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Tests of DataDownloader disk and memory cache on synthetic zips (see synth).
+"""
+
+import os
+import shutil
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+import synth
+from download import COLUMNS, DataDownloader
+from test_fetch import StandInServer
+
+FIELD = COLUMNS.index('usmrtenych osob') - 2  # field in csv line, date and time are one field
+
+
+def edited_zip(src, dst, share, value):
+    """ Writes zip with the first share of lines of every csv file of src, field FIELD is set to value. """
+    with ZipFile(src) as zf_src, ZipFile(dst, 'w') as zf_dst:
+        for member in zf_src.namelist():
+            lines = zf_src.read(member).decode('ISO-8859-2').split('\r\n')[:-1]
+            edited = []
+            for line in lines[:int(len(lines) * share)]:
+                fields = line.split(';')
+                fields[FIELD] = f'"{value}"'
+                edited.append(';'.join(fields) + '\r\n')
+            zf_dst.writestr(member, ''.join(edited).encode('ISO-8859-2'))
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    synth.write_archive('data', 3000, years=(2019, 2020), malformed=0.01)
+    return tmp_path / 'data'
+
+
+def downloader():
+    return DataDownloader(folder='data', offline=True)
+
+
+COLUMNS_USED = ['region', 'ID', 'rok', 'usmrtenych osob']
+
+
+def rows_of(header, data):
+    """ Returns set of rows (tuples of values), order of rows is not compared. """
+    return set(zip(*[np.asarray(column).tolist() for column in data]))
+
+
+def full_rebuild(archive, tmp_path):
+    """ Returns rows of disk cache built from scratch from zips of archive. """
+    fresh = tmp_path / 'fresh'
+    shutil.rmtree(fresh, ignore_errors=True)
+    fresh.mkdir()
+    for name in os.listdir(archive):
+        if name.endswith('.zip'):
+            shutil.copy(archive / name, fresh / name)
+    return rows_of(*DataDownloader(folder='fresh', offline=True).get_list(['JHM', 'PHA'], columns=COLUMNS_USED))
+
+
+def check_rows(archive, tmp_path):
+    """ Checks that incrementally rebuilt cache, cache built from scratch and streamed zips have the same rows and
+    returns them. """
+    d = downloader()
+    rows = rows_of(*d.get_list(['JHM', 'PHA'], columns=COLUMNS_USED))
+    assert rows == full_rebuild(archive, tmp_path)
+
+    streamed = [batch for _, batch in d.iter_batches(['JHM', 'PHA'], 100, COLUMNS_USED, cached=False)]
+    assert rows == rows_of(None, [np.concatenate(column) for column in zip(*streamed)])
+    assert len(rows) == sum(batch[0].shape[0] for batch in streamed)  # no row twice
+    return rows
+
+
+def deaths(rows):
+    return sum(row[3] == 9 for row in rows)
+
+
+def test_overlapping_zips(archive, tmp_path):
+    base = check_rows(archive, tmp_path)
+    half = sum(row[2] == 2020 for row in base) // 2
+
+    # monthly zip is older than yearly zip of the same year, its accidents are overwritten
+    edited_zip(archive / 'datagis-rok-2020.zip', archive / 'datagis-09-2020.zip', 0.5, 9)
+    assert check_rows(archive, tmp_path) == base
+
+    # newer zip overwrites accidents of older zips
+    edited_zip(archive / 'datagis-rok-2020.zip', archive / 'datagis2021.zip', 0.5, 9)
+    superseded = check_rows(archive, tmp_path)
+    assert len(superseded) == len(base) and abs(deaths(superseded) - half) <= 2  # the first half of every csv file
+    assert {row[1] for row in superseded} == {row[1] for row in base}
+
+    # removed zip
+    os.remove(archive / 'datagis2021.zip')
+    assert check_rows(archive, tmp_path) == base
+    os.remove(archive / 'datagis-09-2020.zip')
+    assert check_rows(archive, tmp_path) == base
+    os.remove(archive / 'datagis-rok-2020.zip')
+    assert check_rows(archive, tmp_path) == {row for row in base if row[2] != 2020}
+
+
+def test_lookup(archive):
+    d = downloader()
+    edited_zip(archive / 'datagis-rok-2020.zip', archive / 'datagis2021.zip', 0.5, 9)
+    ids = [np.asarray(d.get_list([reg], columns=['ID'], years=[year])[1][0]) for reg in ['JHM', 'PHA']
+           for year in [2019, 2020]]
+    wanted = np.concatenate([column[::7] for column in ids] + [np.array(['missing'])])
+
+    regions, years, positions = d.lookup(wanted, regions=['JHM', 'PHA'])
+    assert (regions[-1], years[-1], positions[-1]) == ('', -1, -1)
+    for wanted_id, reg, year, position in zip(wanted[:-1], regions, years, positions):
+        column = np.asarray(d.get_list([reg], columns=['ID'], years=[year])[1][0])
+        assert column[position] == wanted_id
+    assert d.lookup(wanted[:1], years=[2018])[2][0] == -1
+
+
+def test_partition_rebuilt_by_another_instance(archive):
+    first = downloader()
+    deaths = first.get_list(['JHM'], columns=['usmrtenych osob'], years=[2020])[1][0]
+    assert not (np.asarray(deaths) == 9).any()
+    first.cube(['region'], regions=['JHM'])
+
+    # another instance sees new zip, rebuilds 2020 and writes metadata which the first instance accepts as current
+    edited_zip(archive / 'datagis-rok-2020.zip', archive / 'datagis2021.zip', 0.5, 9)
+    second = downloader()
+    expected = second.get_list(['JHM'], columns=['ID', 'usmrtenych osob'], years=[2020])[1]
+    assert (np.asarray(expected[1]) == 9).sum() > 0
+
+    header, data = first.get_list(['JHM'], columns=['ID', 'usmrtenych osob'], years=[2020])
+    for column, column_expected in zip(data, expected):
+        np.testing.assert_array_equal(np.asarray(column), np.asarray(column_expected))
+    cube = dict(zip(*first.cube(['region'], regions=['JHM'], years=[2020])))
+    assert cube['usmrtenych osob'][0] == np.asarray(expected[1]).sum()
+    assert first.lookup(np.asarray(expected[0])[:3])[2].tolist() == [0, 1, 2]
+
+
+def publish(server, tmp_path, years):
+    """ Serves page with links to zips of given years and the zips (see DataDownloader.list_zips). """
+    links = []
+    for year in years:
+        name = f'datagis-rok-{year}.zip'
+        if name not in server.files:
+            synth.write_zip(tmp_path / name, year, 500)
+            server.files[name] = (tmp_path / name).read_bytes()
+        links.append(f'<a class="btn btn-sm btn-primary" href="data/{name}">{year}</a>')
+    server.files[''] = ''.join(links).encode()
+
+
+def test_new_zip_is_found_with_cached_regions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = StandInServer()
+    try:
+        publish(server, tmp_path, [2019])
+        url = server.url('')[:-len('data/')]
+        cached = DataDownloader(url, folder='data', listing_ttl=3600)
+        refreshed = DataDownloader(url, folder='data', listing_ttl=0)
+        assert set(np.asarray(refreshed.get_list(['JHM'], columns=['rok'])[1][0])) == {2019}
+
+        # listing is fresh, server is not contacted and cached data are used
+        requests = len(server.requests)
+        assert set(np.asarray(cached.get_list(['JHM'], columns=['rok'])[1][0])) == {2019}
+        assert len(server.requests) == requests
+
+        publish(server, tmp_path, [2019, 2020])
+        assert set(np.asarray(refreshed.get_list(['JHM'], columns=['rok'])[1][0])) == {2019, 2020}
+        assert set(refreshed.cube(['rok'], regions=['JHM'])[1][0]) == {2019, 2020}
+    finally:
+        server.stop()
+
+
+def test_parallel_build(archive):
+    shm = '/dev/shm'
+    before = set(os.listdir(shm)) if os.path.isdir(shm) else set()
+    regions = ['PHA', 'JHM', 'KVK']
+    serial = DataDownloader(folder='data', offline=True, cache_filename='serial_{}').get_list(regions)
+    parallel = DataDownloader(folder='data', offline=True, cache_filename='parallel_{}').get_list(regions, workers=2)
+    assert serial[0] == parallel[0]
+    for column, column_parallel in zip(serial[1], parallel[1]):
+        np.testing.assert_array_equal(np.asarray(column), np.asarray(column_parallel))
+    if os.path.isdir(shm):
+        assert set(os.listdir(shm)) <= before  # all blocks of workers are freed
@@ -0,0 +1,173 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Tests of Fetcher against local stand-in HTTP server (resume by Range and revalidation by ETag).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetch import MANIFEST, PART, Fetcher
+
+
+class StandInServer:
+    """ Local HTTP server of files in memory, it supports ETag, If-None-Match, Range and If-Range.
+
+    Every request is recorded as tuple of path, request headers and response status.
+    """
+
+    def __init__(self):
+        self.files = {}  # file name -> bytes
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.split('/')[-1]
+                if name not in server.files:
+                    self.reply(404)
+                    return
+                data = server.files[name]
+                etag = f'"{hashlib.sha1(data).hexdigest()}"'
+
+                if self.headers.get('If-None-Match') == etag:
+                    self.reply(304, etag=etag)
+                    return
+                ranged = self.headers.get('Range')
+                if ranged and self.headers.get('If-Range') == etag:
+                    start = int(ranged.split('=')[1].rstrip('-'))
+                    if start >= len(data):
+                        self.reply(416, etag=etag)
+                        return
+                    self.reply(206, data[start:], etag, f'bytes {start}-{len(data) - 1}/{len(data)}')
+                    return
+                self.reply(200, data, etag)
+
+            def reply(self, status, body=b'', etag=None, content_range=None):
+                server.requests.append((self.path, dict(self.headers), status))
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                if content_range:
+                    self.send_header('Content-Range', content_range)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, name):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/data/{name}'
+
+    def statuses(self):
+        return [status for _, _, status in self.requests]
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    yield stand_in
+    stand_in.stop()
+
+
+def content(size, seed=0):
+    return bytes((i * 7 + seed) % 251 for i in range(size))
+
+
+def test_download_and_revalidate(server, tmp_path):
+    server.files['a.zip'] = content(100000)
+    path = Fetcher(str(tmp_path)).fetch([server.url('a.zip')])[0]
+    with open(path, 'rb') as f:
+        assert f.read() == server.files['a.zip']
+    assert not os.path.exists(path + PART)
+
+    # unchanged file is only revalidated, new instance reads validators from manifest
+    Fetcher(str(tmp_path)).fetch([server.url('a.zip')])
+    _, headers, status = server.requests[-1]
+    assert status == 304
+    assert headers['If-None-Match'] == json.loads((tmp_path / MANIFEST).read_text())['files']['a.zip']['etag']
+
+
+def test_changed_file_is_downloaded_again(server, tmp_path):
+    server.files['a.zip'] = content(5000)
+    Fetcher(str(tmp_path)).fetch([server.url('a.zip')])
+    server.files['a.zip'] = content(6000, seed=1)
+
+    path = Fetcher(str(tmp_path)).fetch([server.url('a.zip')])[0]
+    assert server.statuses() == [200, 200]
+    with open(path, 'rb') as f:
+        assert f.read() == server.files['a.zip']
+
+
+def test_resume_partial_download(server, tmp_path):
+    data = content(100000)
+    server.files['a.zip'] = data
+    fetcher = Fetcher(str(tmp_path))
+    fetcher.fetch([server.url('a.zip')])
+
+    # killed run left first part of file, validators are already in manifest
+    os.rename(tmp_path / 'a.zip', tmp_path / ('a.zip' + PART))
+    with open(tmp_path / ('a.zip' + PART), 'r+b') as f:
+        f.truncate(30000)
+
+    path = Fetcher(str(tmp_path)).fetch([server.url('a.zip')])[0]
+    _, headers, status = server.requests[-1]
+    assert status == 206
+    assert headers['Range'] == 'bytes=30000-'
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_resume_of_changed_file_starts_again(server, tmp_path):
+    server.files['a.zip'] = content(50000)
+    Fetcher(str(tmp_path)).fetch([server.url('a.zip')])
+    os.rename(tmp_path / 'a.zip', tmp_path / ('a.zip' + PART))
+    with open(tmp_path / ('a.zip' + PART), 'r+b') as f:
+        f.truncate(20000)
+
+    # If-Range does not match, server sends whole new file
+    server.files['a.zip'] = content(40000, seed=3)
+    path = Fetcher(str(tmp_path)).fetch([server.url('a.zip')])[0]
+    assert server.statuses()[-1] == 200
+    with open(path, 'rb') as f:
+        assert f.read() == server.files['a.zip']
+
+
+def test_unsatisfiable_range_starts_again(server, tmp_path):
+    server.files['a.zip'] = content(10000)
+    Fetcher(str(tmp_path)).fetch([server.url('a.zip')])
+    os.rename(tmp_path / 'a.zip', tmp_path / ('a.zip' + PART))
+
+    # the whole file is already in partial file
+    path = Fetcher(str(tmp_path)).fetch([server.url('a.zip')])[0]
+    assert server.statuses()[-2:] == [416, 200]
+    with open(path, 'rb') as f:
+        assert f.read() == server.files['a.zip']
+
+
+def test_concurrent_downloads(server, tmp_path):
+    for i in range(6):
+        server.files[f'{i}.zip'] = content(20000 + i, seed=i)
+    urls = [server.url(f'{i}.zip') for i in range(6)]
+    paths = Fetcher(str(tmp_path), workers=3).fetch(urls)
+    assert [os.path.basename(path) for path in paths] == [f'{i}.zip' for i in range(6)]
+    for i, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            assert f.read() == server.files[f'{i}.zip']
+    assert set(json.loads((tmp_path / MANIFEST).read_text())['files']) == {f'{i}.zip' for i in range(6)}
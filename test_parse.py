@@ -0,0 +1,140 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Tests of vectorized csv parser against line by line parsing of csv module (original format_line2).
+"""
+
+import csv
+import io
+
+import numpy as np
+import pytest
+
+import synth
+from download import RAW_LEN, floats, ints, parse_csv, read_csv, strings, types
+
+NAN = -99999
+
+
+def format_line2(data, data_list, j, nan=NAN):
+    """ Formats one row as original DataDownloader.format_line2 did. """
+    data.insert(6, nan)  # placeholder because time is divided into hours, minutes
+    time = data[5]
+    data[5] = (lambda x: x if int(x) < 25 else nan)(time[:2])  # 25 is unknown time  for hours
+    data[6] = (lambda x: x if int(x) < 60 else nan)(time[2:])  # 60 is unknown time for minutes
+
+    year, m_d = data[3].split('-', 1)
+    data.insert(3, year)
+    data[4] = m_d
+
+    for i in floats:
+        try:
+            data_list[i][j] = data[i].replace(',', '.')
+        except ValueError:
+            data_list[i][j] = nan
+    for i in ints:
+        try:
+            data_list[i][j] = data[i]
+        except ValueError:
+            data_list[i][j] = nan
+    for i in strings:
+        data_list[i][j] = data[i]
+
+
+def reference(data):
+    """ Parses csv file by csv module and format_line2, empty lines are not rows. """
+    text = io.StringIO(data.decode('ISO-8859-2'), newline='')
+    rows = [row for row in csv.reader(text, delimiter=';', quotechar='"') if row]
+    data_list = [np.empty(len(rows), dtype=t) for t in types]
+    for j, row in enumerate(rows):
+        format_line2(row, data_list, j)
+    return data_list
+
+
+def assert_same(parsed, expected):
+    assert len(parsed) == len(expected)
+    for i, (column, column_expected) in enumerate(zip(parsed, expected)):
+        np.testing.assert_array_equal(column, column_expected, err_msg=f'column {i}')
+
+
+def raw_index(i):
+    """ Returns index of field in csv row for index of parsed column. """
+    return i if i < 3 else {3: 3, 4: 3, 5: 4, 6: 5, 7: 5}.get(i, i - 2)
+
+
+def synthetic_rows(rows, seed=0, malformed=0.05):
+    """ Returns csv rows (lists of fields) generated as in synthetic zips. """
+    data = synth.pack(synth.generate(np.random.default_rng(seed), rows, 2020, '06', 0, malformed))
+    return list(csv.reader(io.StringIO(data.decode('ISO-8859-2'), newline=''), delimiter=';', quotechar='"'))
+
+
+def to_csv(rows, newline='\r\n'):
+    """ Writes rows as in csv files on server, every field is quoted. """
+    lines = [';'.join('"' + field.replace('"', '""') + '"' for field in row) for row in rows]
+    return newline.join(lines).encode('ISO-8859-2') + newline.encode()
+
+
+def test_synthetic_file():
+    data = to_csv(synthetic_rows(2000))
+    assert_same(parse_csv(data, NAN), reference(data))
+
+
+@pytest.mark.parametrize('value', ['a;b', ';', 'say "hi"', '""', '"', ';"; ', 'Náměstí Míru', ''])
+def test_quoted_strings(value):
+    rows = synthetic_rows(3)
+    for i in strings:
+        if i not in (3, 4):
+            rows[1][raw_index(i)] = value
+    data = to_csv(rows)
+    parsed = parse_csv(data, NAN)
+    assert_same(parsed, reference(data))
+    assert parsed[strings[-1]][1] == value
+
+
+@pytest.mark.parametrize('time, hour, minute', [('2560', NAN, NAN), ('2517', NAN, 17), ('1260', 12, NAN),
+                                                ('0000', 0, 0), ('2359', 23, 59), ('0999', 9, NAN)])
+def test_time_sentinels(time, hour, minute):
+    rows = synthetic_rows(2)
+    rows[0][raw_index(6)] = time
+    data = to_csv(rows)
+    parsed = parse_csv(data, NAN)
+    assert_same(parsed, reference(data))
+    assert (parsed[6][0], parsed[7][0]) == (hour, minute)
+
+
+@pytest.mark.parametrize('value', ['', 'XX', 'A:', '1,2,3', '-1,5', '12', ' 7'])
+def test_malformed_numbers(value):
+    rows = synthetic_rows(2)
+    for i in floats + [i for i in ints if i not in (3, 6, 7)]:
+        rows[0][raw_index(i)] = value
+    data = to_csv(rows)
+    assert_same(parse_csv(data, NAN), reference(data))
+
+
+@pytest.mark.parametrize('newline', ['\r\n', '\n'])
+def test_line_endings_and_empty_lines(newline):
+    rows = synthetic_rows(5)
+    lines = to_csv(rows, newline).split(newline.encode())
+    data = (newline * 2).encode().join(lines[:3]) + newline.encode() + newline.encode().join(lines[3:])
+    assert_same(parse_csv(data, NAN), reference(data))
+    assert parse_csv(data, NAN)[0].shape[0] == 5
+
+    # the last row without newline
+    data = to_csv(rows, newline)[:-len(newline)]
+    assert_same(parse_csv(data, NAN), reference(data))
+
+
+def test_empty_file():
+    parsed = parse_csv(b'', NAN)
+    assert len(parsed) == len(types) and all(column.shape[0] == 0 for column in parsed)
+    assert RAW_LEN == len(types) - 2
+
+
+@pytest.mark.parametrize('chunk_size', [97, 1000, 1 << 16])
+def test_chunked_read(chunk_size):
+    rows = synthetic_rows(500, seed=1)
+    rows[10][raw_index(strings[-1])] = 'line\r\nbreak; "quoted"'  # newline inside quoted field
+    data = to_csv(rows)
+    chunks = list(read_csv(io.BytesIO(data), NAN, chunk_size))
+    assert_same([np.concatenate(column) for column in zip(*chunks)], reference(data))
@@ -0,0 +1,93 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Tests of tile store against local stand-in tile server (prefetch, LRU eviction and offline serving).
+"""
+
+import pytest
+import requests
+
+import tiles
+from tiles import BLANK, TileServer, TileStore, fake_tile, prefetch, tiles_in
+
+BOUNDS = (16.5, 49.1, 16.7, 49.3)  # surroundings of Brno
+
+
+@pytest.fixture
+def upstream():
+    """ Stand-in upstream serving generated tiles, requested tiles are recorded. """
+    requested = []
+
+    def get_tile(z, x, y):
+        requested.append((z, x, y))
+        return fake_tile(z, x, y)
+
+    server = TileServer(get_tile, blank=False).start()
+    server.requested = requested
+    yield server
+    server.stop()
+
+
+def test_prefetch(upstream, tmp_path):
+    store = TileStore(str(tmp_path / 'tiles'), upstream.url, offline=False)
+    total, missing = prefetch(store, BOUNDS, zooms=[11, 12], workers=4)
+    tile_keys = tiles_in(BOUNDS, 11) + tiles_in(BOUNDS, 12)
+    assert (total, missing) == (len(tile_keys), 0)
+    assert sorted(upstream.requested) == sorted(tile_keys)
+    assert store.misses == total and store.bytes == sum(len(fake_tile(*tile)) for tile in tile_keys)
+
+    # stored tiles are only marked as used, new store reads them from disk
+    store = TileStore(str(tmp_path / 'tiles'), upstream.url, offline=False)
+    assert prefetch(store, BOUNDS, zooms=[11, 12]) == (total, 0)
+    assert len(upstream.requested) == total and store.hits == total
+    assert all(store.get(*tile) == fake_tile(*tile) for tile in tile_keys)
+
+
+def test_lru_eviction(upstream, tmp_path):
+    tile_keys = [(14, 8960, 5690 + i) for i in range(5)]
+    size = max(len(fake_tile(*tile)) for tile in tile_keys)
+    store = TileStore(str(tmp_path / 'tiles'), upstream.url, max_bytes=3 * size, offline=False)
+    for tile in tile_keys[:3]:
+        store.get(*tile)
+    store.get(*tile_keys[0])  # the first tile is used again, so the second one is the least recently used
+
+    store.get(*tile_keys[3])
+    assert tile_keys[1] not in store and all(tile in store for tile in [tile_keys[0], tile_keys[2], tile_keys[3]])
+    store.put(*tile_keys[4], fake_tile(*tile_keys[4]))
+    assert tile_keys[2] not in store and tile_keys[0] in store
+    assert store.evictions == 2 and store.bytes <= store.max_bytes
+
+    # size of store matches files on disk
+    reopened = TileStore(str(tmp_path / 'tiles'), upstream.url, max_bytes=3 * size, offline=True)
+    assert reopened.bytes == store.bytes == sum(size for _, _, size in store.files())
+    assert len(store.files()) == 3
+
+
+def test_offline_serving(upstream, tmp_path):
+    store = TileStore(str(tmp_path / 'tiles'), upstream.url, offline=False)
+    store.get(12, 2238, 1405)
+    requested = len(upstream.requested)
+
+    offline = TileStore(str(tmp_path / 'tiles'), upstream.url, offline=True)
+    with TileServer(offline.get) as url:
+        response = requests.get(url.format(z=12, x=2238, y=1405))
+        assert response.status_code == 200 and response.content == fake_tile(12, 2238, 1405)
+        response = requests.get(url.format(z=12, x=2239, y=1405))
+        assert response.status_code == 200 and response.content == BLANK
+    assert len(upstream.requested) == requested  # upstream is never contacted
+    assert (offline.hits, offline.misses) == (1, 1)
+
+    server = TileServer(offline.get, blank=False).start()
+    try:
+        assert requests.get(server.url.format(z=12, x=2239, y=1405)).status_code == 404
+        assert server.missing == 1
+    finally:
+        server.stop()
+
+
+def test_shared_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tiles, 'stores', {})
+    assert tiles.shared_store() is tiles.shared_store()
+    assert tiles.shared_store('other') is not tiles.shared_store()
@@ -0,0 +1,331 @@
+"""
+Author: Marek Sarvas
+School: VUT FIT
+Project: IZV
+Description: Offline store of basemap tiles with LRU eviction, tile prefetching and local tile server for contextily.
+"""
+
+import argparse
+import hashlib
+import io
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+import instrument
+
+# upstream of Stamen TonerLite tiles used by geo plots
+TILE_URL = 'https://tiles.stadiamaps.com/tiles/stamen_toner_lite/{z}/{x}/{y}.png'
+OFFLINE = 'IZV_OFFLINE'  # when set to 1, tiles are read only from store and never downloaded
+TILE_SIZE = 256  # pixels of tile side
+MAX_LAT = 85.0511287798  # latitude limit of web mercator
+
+
+def tile_xy(lon, lat, zoom):
+    """ Returns indexes of tile containing given WGS84 point at zoom level (slippy map tile names).
+
+    :param lon: longitude in degrees
+    :param lat: latitude in degrees
+    :param zoom: zoom level
+    :return: tuple of x and y of tile
+    """
+    n = 1 << zoom
+    lat = math.radians(min(max(lat, -MAX_LAT), MAX_LAT))
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in(bounds, zoom):
+    """ Returns tiles covering WGS84 bounding box at zoom level.
+
+    :param bounds: tuple of west, south, east and north in degrees
+    :param zoom: zoom level
+    :return: list of tuples (zoom, x, y)
+    """
+    west, south, east, north = bounds
+    x0, y0 = tile_xy(west, north, zoom)
+    x1, y1 = tile_xy(east, south, zoom)
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def auto_zoom(bounds):
+    """ Returns zoom level which contextily chooses for bounding box (add_basemap with zoom='auto').
+
+    :param bounds: tuple of west, south, east and north in degrees
+    :return: zoom level
+    """
+    west, south, east, north = bounds
+    zoom_lon = math.ceil(math.log2(360 * 2.0 / (east - west)))
+    zoom_lat = math.ceil(math.log2(360 * 2.0 / (north - south)))
+    return int(min(zoom_lon, zoom_lat))
+
+
+def png(rgba):
+    """ Encodes RGBA image (numpy array of floats 0-1) into PNG bytes. """
+    from matplotlib.image import imsave
+
+    buf = io.BytesIO()
+    imsave(buf, rgba, format='png')
+    return buf.getvalue()
+
+
+BLANK = png(np.zeros((TILE_SIZE, TILE_SIZE, 4)))  # transparent tile, served for tiles missing in offline store
+
+
+class TileStore:
+    """ On-disk store of tiles of one tile source, limited by size of stored tiles in bytes.
+
+    Tile is stored in file '{folder}/{z}/{x}/{y}.png', modification time of file is time of its last use, so least
+    recently used tiles are evicted first when size of store exceeds budget. Missing tiles are downloaded from url,
+    in offline mode only stored tiles are returned. Counts hits, misses and evictions. Order of use is kept in memory,
+    tile tree is walked only once when store is opened.
+    """
+
+    def __init__(self, folder='tiles', url=TILE_URL, max_bytes=256 << 20, offline=None, timeout=30):
+        self.folder = folder
+        self.url = url  # template of tile url with {z}, {x} and {y}
+        self.max_bytes = max_bytes  # budget in bytes, unlimited if None
+        self.offline = os.environ.get(OFFLINE) == '1' if offline is None else offline  # never download tiles
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index = OrderedDict((path, size) for _, path, size in sorted(self.files()))  # least recently used first
+        self.bytes = sum(self.index.values())
+
+    def path(self, z, x, y):
+        """ Returns path to file of tile. """
+        return os.path.join(self.folder, str(z), str(x), f'{y}.png')
+
+    def files(self):
+        """ Returns list of stored tiles as tuples of (time of last use, path, size in bytes). """
+        found = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if name.endswith('.png'):
+                    stat = os.stat(os.path.join(root, name))
+                    found.append((stat.st_mtime, os.path.join(root, name), stat.st_size))
+        return found
+
+    def __contains__(self, tile):
+        return os.path.exists(self.path(*tile))
+
+    def get(self, z, x, y):
+        """ Returns PNG bytes of tile and marks it as recently used, missing tile is downloaded unless offline.
+
+        :return: bytes of tile, None if tile is not stored and could not be downloaded
+        """
+        path = self.path(z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # recently used, order is kept for next runs
+            with self.lock:
+                self.hits += 1
+                if path in self.index:
+                    self.index.move_to_end(path)
+                else:  # stored by another process
+                    self.index[path] = len(data)
+                    self.bytes += len(data)
+            return data
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+
+        if self.offline:
+            return None
+        with instrument.span('download_tile', z=z):
+            response = requests.get(self.url.format(z=z, x=x, y=y), timeout=self.timeout,
+                                    headers={'User-Agent': 'IZV tile store'})
+        if response.status_code != 200:
+            return None
+        self.put(z, x, y, response.content)
+        return response.content
+
+    def put(self, z, x, y, data):
+        """ Stores tile, least recently used tiles are evicted to fit into budget.
+
+        :param data: PNG bytes of tile
+        """
+        path = self.path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)  # readers never see partially written tile
+
+        with self.lock:
+            self.bytes += len(data) - self.index.pop(path, 0)
+            self.index[path] = len(data)
+            if self.max_bytes is not None and self.bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ Removes least recently used tiles until size of store fits into budget. """
+        while self.index and self.bytes > self.max_bytes:
+            path, size = self.index.popitem(last=False)
+            self.bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # already removed by another process
+                continue
+            self.evictions += 1
+
+
+stores = {}  # folder -> TileStore shared by plots of this process
+
+
+def shared_store(folder='tiles'):
+    """ Returns TileStore of folder shared by all plots, so tile tree is walked only once per process.
+
+    :param folder: directory of tile store
+    :return: TileStore with default settings
+    """
+    if folder not in stores:
+        stores[folder] = TileStore(folder)
+    return stores[folder]
+
+
+def prefetch(store, bounds, zooms=None, workers=8):
+    """ Downloads all tiles of bounding box at given zoom levels into store, stored tiles are only marked as used.
+
+    :param store: TileStore
+    :param bounds: WGS84 bounding box, tuple of west, south, east and north in degrees
+    :param zooms: list of zoom levels, zoom chosen by contextily for bounding box if not set
+    :param workers: number of tiles downloaded at once
+    :return: tuple of number of tiles in bounding box and number of tiles which are not available
+    """
+    zooms = [auto_zoom(bounds)] if zooms is None else zooms
+    tiles = [tile for zoom in zooms for tile in tiles_in(bounds, zoom)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        missing = sum(data is None for data in pool.map(lambda tile: store.get(*tile), tiles))
+    return len(tiles), missing
+
+
+def region_bounds(region, downloader=None):
+    """ Returns WGS84 bounding box of crashes of region (from 'd' and 'e' S-JTSK coordinates).
+
+    :param region: region code (e.g. 'JHM')
+    :param downloader: DataDownloader providing data, default one is created if not set
+    :return: tuple of west, south, east and north in degrees
+    """
+    import geopandas
+    from download import DataDownloader
+
+    df = (downloader or DataDownloader()).get_dataframe(regions=[region], columns=['d', 'e']).dropna()
+    points = geopandas.GeoSeries(geopandas.points_from_xy(df['d'], df['e']), crs='EPSG:5514')
+    return tuple(points.to_crs(epsg=4326).total_bounds)
+
+
+def fake_tile(z, x, y):
+    """ Returns generated tile with colour given by its position, used by stand-in tile server instead of upstream. """
+    digest = hashlib.sha1(f'{z}/{x}/{y}'.encode()).digest()
+    rgba = np.empty((TILE_SIZE, TILE_SIZE, 4))
+    rgba[:, :, :3] = np.frombuffer(digest[:3], dtype=np.uint8) / 255
+    rgba[:, :, 3] = 1
+    return png(rgba)
+
+
+class TileServer:
+    """ Local HTTP server of tiles in background thread, its url is used as tile source of contextily.
+
+    Tiles are provided by function (e.g. TileStore.get), tiles which are not available are served as transparent
+    tiles (or 404 if blank is False) and counted. Used as context manager, url template is returned by with.
+    """
+
+    def __init__(self, get_tile, host='127.0.0.1', port=0, blank=True):
+        self.get_tile = get_tile  # function (z, x, y) -> PNG bytes or None
+        self.blank = blank
+        self.missing = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = re.match(r'^/(\d+)/(\d+)/(\d+)\.png$', self.path)
+                data = server.get_tile(*map(int, match.groups())) if match else None
+                if data is None:
+                    server.missing += 1
+                    if not server.blank or not match:
+                        self.send_error(404)
+                        return
+                    data = BLANK
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass  # no log of every tile
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """ Returns template of tile url of server. """
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{{z}}/{{x}}/{{y}}.png'
+
+    def start(self):
+        """ Starts serving tiles in background thread. """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops server and closes its socket. """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start().url
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', default='tiles', help='Set directory of tile store')
+    parser.add_argument('--url', default=TILE_URL, help='Set template of upstream tile url')
+    parser.add_argument('--max-mb', type=int, default=256, help='Set size limit of tile store in MB')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch_parser = subparsers.add_parser('prefetch', help='Download tiles of region into store')
+    fetch_parser.add_argument('--region', default='JHM', help='Set region whose bounding box is downloaded')
+    fetch_parser.add_argument('--bbox', type=float, nargs=4, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                              help='Set WGS84 bounding box instead of region')
+    fetch_parser.add_argument('--zooms', type=int, nargs='+', help='Set zoom levels, zoom of plots if not set')
+    fetch_parser.add_argument('--workers', type=int, default=8, help='Set number of tiles downloaded at once')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve tiles of store (offline) or generated tiles')
+    serve_parser.add_argument('--port', type=int, default=8080, help='Set port of server')
+    serve_parser.add_argument('--fake', action='store_true', help='Set to serve generated tiles (stand-in upstream)')
+    args = parser.parse_args()
+
+    if args.command == 'prefetch':
+        tile_store = TileStore(args.folder, args.url, args.max_mb << 20, offline=False)
+        box = tuple(args.bbox) if args.bbox else region_bounds(args.region)
+        total, unavailable = prefetch(tile_store, box, args.zooms, args.workers)
+        print(f'tiles: {total}, unavailable: {unavailable}, stored: {tile_store.bytes / (1 << 20):.1f} MB, '
+              f'evictions: {tile_store.evictions}')
+    else:
+        tile_store = TileStore(args.folder, args.url, args.max_mb << 20, offline=True)
+        tile_server = TileServer(fake_tile if args.fake else tile_store.get, port=args.port, blank=not args.fake)
+        print(f'serving {tile_server.url}')
+        try:
+            tile_server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            tile_server.httpd.server_close()